@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the dogstatsd receive and aggregation paths.
+
+Run from the repository root, e.g.:
+
+    python bench/bench_dogstatsd.py recv --packets 200000 --batch-sizes 1,64
+    python bench/bench_dogstatsd.py parse --lines 500000
+    python bench/bench_dogstatsd.py submit --contexts 200000 --types c,g
+    python bench/bench_dogstatsd.py decode --lines 500000
+    python bench/bench_dogstatsd.py memory --contexts 100000
+    python bench/bench_dogstatsd.py histograms --samples 1000
+    python bench/bench_dogstatsd.py reuse --contexts 50000 --rounds 5
+    python bench/bench_dogstatsd.py flushmem --contexts 200000
+
+Each benchmark prints one line per variant so runs can be compared.
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+import aggregator  # noqa: E402
+import dogstatsd  # noqa: E402
+
+SAMPLE_LINES = [
+    "page.views:1|c|#country:china,env:prod",
+    "fuel.level:0.5|g|#env:prod",
+    "song.length:240|h|@0.5|#genre:rock",
+    "page.loadtime:1234|ms|#page:home,env:prod",
+    "users.uniques:1234|s",
+]
+
+
+# What client libraries typically send: mostly tagged counters and timers, some
+#  sampled, a few multi-value lines and magic host tags.
+PARSE_CORPUS = SAMPLE_LINES + [
+    "api.requests:1|c|#endpoint:/v1/users,method:get,status:200,env:prod",
+    "api.requests:1|c|@0.1|#endpoint:/v1/orders,method:post,status:201,env:prod",
+    "api.latency:12.5|ms|#endpoint:/v1/users,method:get,env:prod",
+    "api.latency:48|ms|@0.25|#endpoint:/v1/orders,method:post,env:prod",
+    "queue.depth:17|g|#queue:emails,host:worker-3",
+    "cache.hits:3|c:1|c|#cache:sessions,env:prod",
+    "db.query.time:3|ms|#db:users,table:accounts,op:select,device:sda1",
+    "jvm.heap.used:123456789|g",
+]
+
+
+def _old_parse(agg, line):
+    """ The contexts submit_packets built before the single-pass parser """
+    parsed = []
+    for name, value, mtype, tags, sample_rate in agg.parse_metric_packet(line):
+        hostname, device_name, tags = agg._extract_magic_tags(tags)
+        hostname = hostname if hostname is not None else agg.hostname
+        if tags is None:
+            context = (name, tuple(), hostname, device_name)
+        else:
+            context = (name, tuple(sorted(set(tags))), hostname, device_name)
+        parsed.append((context, value, mtype, sample_rate))
+    return parsed
+
+
+def bench_parse(args):
+    """ Lines/s of the metric line parsers, from a line to its aggregation context. """
+    agg = aggregator.MetricsBucketAggregator('bench-host')
+    corpus = PARSE_CORPUS
+    lines = [corpus[i % len(corpus)] for i in xrange(args.lines)]
+    for line in corpus:
+        assert _old_parse(agg, line) == agg.parse_metric_line(line), line
+
+    uncached = aggregator.MetricsBucketAggregator('bench-host', context_cache_size=0)
+    for label, parse in [('split', lambda line: _old_parse(agg, line)),
+                         ('single-pass', uncached.parse_metric_line),
+                         ('cached', agg.parse_metric_line)]:
+        start = time.time()
+        for line in lines:
+            parse(line)
+        elapsed = time.time() - start
+        print "parse %-12s lines=%-8d %10.0f lines/s" % (label, len(lines), len(lines) / elapsed)
+
+
+def bench_decode(args):
+    """ Lines/s of UTF-8 decoding plus parsing, on ASCII-only and mixed datagrams. """
+    # One line in ten has non-ASCII tags
+    mixed_corpus = [line if i % 10 else line + ",city:z\xc3\xbcrich"
+                    for i, line in enumerate(PARSE_CORPUS) if '#' in line]
+    for corpus_name, corpus in [('ascii', PARSE_CORPUS), ('mixed', mixed_corpus)]:
+        # Datagrams of 10 lines, as batching clients send them
+        datagrams = ['\n'.join(corpus[(i + j) % len(corpus)] for j in range(10))
+                     for i in xrange(args.lines // 10)]
+        nlines = len(datagrams) * 10
+        # What submit_packets did before: decode the whole datagram, then parse text
+        decode_all = aggregator.MetricsBucketAggregator('bench-host')
+        lazy = aggregator.MetricsBucketAggregator('bench-host', utf8_decoding=True)
+        for label, agg, decode in [
+                ('decode-all', decode_all, lambda packets: unicode(packets, 'utf-8', errors='replace')),
+                ('lazy', lazy, lambda packets: packets)]:
+            start = time.time()
+            for packets in datagrams:
+                agg.split_packet_lines(decode(packets))
+            split_elapsed = time.time() - start
+            start = time.time()
+            for packets in datagrams:
+                agg.submit_packets(decode(packets))
+            elapsed = time.time() - start
+            print "decode %-5s %-10s lines=%-8d split %10.0f lines/s  submit %10.0f lines/s" % (
+                corpus_name, label, nlines, nlines / split_elapsed, nlines / elapsed)
+
+
+def _submit_run(storage, lines, rounds, results):
+    agg = aggregator.MetricsBucketAggregator('bench-host', interval=10,
+                                             context_cache_size=len(lines),
+                                             storage=storage)
+    # A fixed clock, so that every round fills the same bucket
+    now = [1000.0]
+    aggregator.time = lambda: now[0]
+    rates = []
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for rnd in range(rounds):
+        start = time.time()
+        for line in lines:
+            agg.submit_packets(line)
+        rates.append(len(lines) / (time.time() - start))
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    contexts = len(agg.contexts)
+    # Flush every pending bucket
+    now[0] += agg.interval
+    start = time.time()
+    points = len(agg.flush())
+    elapsed = time.time() - start
+    results.put((rates, contexts, points, elapsed, (rss_after - rss_before) / 1024.0))
+
+
+def bench_submit(args):
+    """ Lines/s through a bucket aggregator, its flush time and the memory its contexts take. """
+    types = ['c', 'g', 'ms', 's']
+    if args.types:
+        types = args.types.split(',')
+    lines = ["app.metric.%d:%d|%s|#service:svc%d,env:prod,zone:z%d" % (
+        i % 500, i, types[i % len(types)], i // 500, i % 3)
+        for i in xrange(args.contexts)]
+    for storage in args.storages.split(','):
+        results = multiprocessing.Queue()
+        # A fresh process each, max rss only ever grows
+        process = multiprocessing.Process(target=_submit_run,
+                                          args=(storage, lines, args.rounds, results))
+        process.start()
+        rates, contexts, points, elapsed, growth = results.get()
+        process.join()
+        for rnd, rate in enumerate(rates):
+            print "submit %-8s round=%d contexts=%-7d %10.0f lines/s" % (
+                storage, rnd, contexts, rate)
+        print "submit %-8s flush %d points in %.0fms" % (storage, points, 1000 * elapsed)
+        print "submit %-8s max rss growth %.1f MB for %d contexts" % (
+            storage, growth, args.contexts)
+
+
+def bench_histograms(args):
+    """ Flush time of busy exact histograms, with and without NumPy. """
+    samples = [(i * 7919) % 1000 / 10.0 for i in xrange(args.samples)]
+    variants = [('python', None)]
+    if aggregator.numpy is not None:
+        variants.append(('numpy', aggregator.numpy))
+    saved = aggregator.numpy
+    try:
+        for label, numpy in variants:
+            aggregator.numpy = numpy
+            histograms = []
+            for i in xrange(args.contexts):
+                histogram = aggregator.Histogram(aggregator.api_formatter, 'timer.%d' % i,
+                                                 None, 'bench-host', None)
+                for value in samples:
+                    histogram.sample(value, 1)
+                histograms.append(histogram)
+            start = time.time()
+            points = aggregator.Histogram.flush_all(histograms, time.time(), 10)
+            elapsed = time.time() - start
+            print "histograms %-6s contexts=%-6d samples=%-6d flush %d points in %.0fms" % (
+                label, args.contexts, args.samples, len(points), 1000 * elapsed)
+    finally:
+        aggregator.numpy = saved
+
+
+def bench_reuse(args):
+    """ Metric objects created per flush interval by a steady set of series, with and without reuse. """
+    types = ['c', 'g', 'ms', 's']
+    if args.types:
+        types = args.types.split(',')
+    lines = ["app.metric.%d:%d|%s|#service:svc%d" % (i % 500, i, types[i % len(types)], i // 500)
+             for i in xrange(args.contexts)]
+    created = [0]
+    from_descriptor = aggregator.Metric.__dict__['from_descriptor']
+
+    def counting_from_descriptor(cls, descriptor, extra_config=None):
+        created[0] += 1
+        return from_descriptor.__func__(cls, descriptor, extra_config)
+
+    now = [1000.0]
+    aggregator.time = lambda: now[0]
+    aggregator.Metric.from_descriptor = classmethod(counting_from_descriptor)
+    try:
+        for recycle in [False, True]:
+            agg = aggregator.MetricsBucketAggregator('bench-host', interval=10,
+                                                     context_cache_size=args.contexts)
+            agg.recycle_metrics = recycle
+            for rnd in range(args.rounds):
+                created[0] = 0
+                start = time.time()
+                for i in xrange(0, len(lines), 64):
+                    agg.submit_packets('\n'.join(lines[i:i + 64]))
+                now[0] += agg.interval
+                agg.flush()
+                elapsed = time.time() - start
+                print "reuse %-5s round=%d contexts=%-7d %7d metrics created, submit+flush %.0fms" % (
+                    recycle, rnd, len(agg.contexts), created[0], 1000 * elapsed)
+    finally:
+        aggregator.Metric.from_descriptor = from_descriptor
+        aggregator.time = time.time
+
+
+def _flush_peak(mode, contexts, results):
+    agg = aggregator.MetricsBucketAggregator('bench-host', interval=10, context_cache_size=0)
+    lines = ["app.metric.%d:1|c|#service:svc%d" % (i % 500, i // 500) for i in xrange(contexts)]
+    now = [1000.0]
+    aggregator.time = lambda: now[0]
+    # The second flush is measured, once the aggregator's own state is built
+    for rnd in range(2):
+        for i in xrange(0, len(lines), 64):
+            agg.submit_packets('\n'.join(lines[i:i + 64]))
+        now[0] += agg.interval
+        if rnd == 0:
+            agg.flush()
+    del lines
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    batches = [agg.flush()] if mode == 'list' else agg.flush_batches()
+    points = 0
+    for batch in batches:
+        # The copy SignalfxPointSender makes before handing the points over
+        payload = [{'metric': point['metric'], 'value': point['points'][0][1],
+                    'timestamp': int(point['points'][0][0] * 1000)} for point in batch]
+        points += len(payload)
+    elapsed = time.time() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((points, (rss_after - rss_before) / 1024.0, elapsed))
+
+
+def bench_flushmem(args):
+    """ Peak memory growth of a flush and of the copy sent, as one list or in batches. """
+    for mode in ['list', 'batches']:
+        results = multiprocessing.Queue()
+        # A fresh process each, max rss only ever grows
+        process = multiprocessing.Process(target=_flush_peak, args=(mode, args.contexts, results))
+        process.start()
+        points, growth, elapsed = results.get()
+        process.join()
+        print "flushmem %-7s contexts=%-7d %d points, max rss growth %.1f MB, %.0fms" % (
+            mode, args.contexts, points, growth, 1000 * elapsed)
+
+
+class _DictCounter(object):
+    """ A Counter as it was stored before metrics had __slots__ """
+
+    def __init__(self, formatter, name, tags, hostname, device_name):
+        self.formatter = formatter
+        self.name = name
+        self.tags = tags
+        self.hostname = hostname
+        self.device_name = device_name
+        self.last_sample_time = None
+        self.value = 0
+
+
+def _metric_bytes(metric):
+    """ Bytes held by a metric object itself, not counting what it shares with others """
+    size = sys.getsizeof(metric)
+    if hasattr(metric, '__dict__'):
+        size += sys.getsizeof(metric.__dict__)
+    return size
+
+
+def bench_memory(args):
+    """ Bytes per live series of the metric objects of a bucket aggregator. """
+    agg = aggregator.MetricsBucketAggregator('bench-host', interval=10,
+                                             context_cache_size=0)
+    lines = ["app.metric.%d:%d|c|#service:svc%d,env:prod" % (i % 500, i, i // 500)
+             for i in xrange(args.contexts)]
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for line in lines:
+        agg.submit_packets(line)
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    metrics = [metric for metric_by_id in agg.generation.metric_by_bucket.values()
+               for metric in metric_by_id.itervalues()]
+    slotted = sum(_metric_bytes(m) for m in metrics)
+    descriptors = sum(sys.getsizeof(d) for d in agg.descriptors if d is not None)
+    legacy = [_DictCounter(agg.formatter, m.name, m.tags, m.hostname, m.device_name)
+              for m in metrics]
+    dict_based = sum(_metric_bytes(m) for m in legacy)
+    n = len(metrics)
+    print "memory contexts=%-7d dict metrics      %6.0f bytes/series" % (n, float(dict_based) / n)
+    print "memory contexts=%-7d slotted metrics   %6.0f bytes/series (+%.0f per context for its descriptor)" % (
+        n, float(slotted) / n, float(descriptors) / n)
+    print "memory max rss growth %.1f MB for %d contexts, all aggregator state" % (
+        (rss_after - rss_before) / 1024.0, n)
+
+
+def _blast(address, packets):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    lines = SAMPLE_LINES
+    nlines = len(lines)
+    for i in xrange(packets):
+        try:
+            sock.sendto(lines[i % nlines], address)
+        except socket.error:
+            pass
+    sock.close()
+
+
+def bench_recv(args):
+    """ Datagrams/s and drop rate of the server for each receive batch size. """
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        server = dogstatsd.init('127.0.0.1', 0, timeout=.1,
+                                batch_size=batch_size,
+                                listeners=args.listeners,
+                                workers=args.workers,
+                                queue_size=args.queue_size)
+        thread = threading.Thread(target=server.start)
+        thread.daemon = True
+        thread.start()
+        server.running.wait(5)
+
+        start = time.time()
+        # Several senders so that SO_REUSEPORT hashes them over the listeners
+        per_sender = args.packets // args.senders
+        senders = [multiprocessing.Process(target=_blast,
+                                           args=(server.address, per_sender))
+                   for _ in range(args.senders)]
+        for sender in senders:
+            sender.start()
+        # Stand-in for collectd's other Python callbacks: how late does a
+        #  1ms sleep wake up while the receiver holds the GIL?
+        lags = []
+        while any(sender.is_alive() for sender in senders):
+            before = time.time()
+            time.sleep(.001)
+            lags.append(time.time() - before - .001)
+        for sender in senders:
+            sender.join()
+        # Give the receiver a moment to drain what is left in the queue
+        last = -1
+        while last != server.datagrams_received:
+            last = server.datagrams_received
+            time.sleep(.2)
+        elapsed = time.time() - start - .2
+        server.stop()
+        thread.join()
+        server.metrics_aggregator.close()
+
+        sent = per_sender * args.senders
+        received = server.datagrams_received
+        lags.sort()
+        print ("recv listeners=%d workers=%d batch_size=%-4d received=%-8d "
+               "%10.0f pkt/s  drop=%5.1f%%  main-thread lag p99=%.1fms" % (
+                   args.listeners, args.workers, batch_size, received,
+                   received / elapsed, 100.0 * (sent - received) / sent,
+                   1000 * lags[int(len(lags) * .99)] if lags else 0))
+
+
+# Number of contexts each benchmark uses unless --contexts is given
+DEFAULT_CONTEXTS = {
+    'histograms': 2000,
+}
+
+BENCHMARKS = {
+    'recv': bench_recv,
+    'parse': bench_parse,
+    'submit': bench_submit,
+    'decode': bench_decode,
+    'memory': bench_memory,
+    'histograms': bench_histograms,
+    'reuse': bench_reuse,
+    'flushmem': bench_flushmem,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--packets', type=int, default=200000)
+    parser.add_argument('--lines', type=int, default=500000)
+    parser.add_argument('--contexts', type=int, default=None)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--samples', type=int, default=500)
+    parser.add_argument('--storages', default=','.join(aggregator.STORAGES))
+    parser.add_argument('--types', default='')
+    parser.add_argument('--batch-sizes', default='1,64')
+    parser.add_argument('--listeners', type=int, default=1)
+    parser.add_argument('--senders', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=0)
+    parser.add_argument('--queue-size', type=int, default=0)
+    args = parser.parse_args()
+    if args.contexts is None:
+        args.contexts = DEFAULT_CONTEXTS.get(args.benchmark, 200000)
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -34,11 +34,23 @@ OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 # stdlib
+from array import array
+from collections import deque, namedtuple
 import logging
+import re
+import threading
 from time import time
 
+# NumPy is optional, histograms are flushed in pure Python without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # project
 #from checks.metric_types import MetricTypes
+from sketch import DDSketch, HyperLogLog, DEFAULT_PRECISION, DEFAULT_RELATIVE_ERROR, MAX_PRECISION, \
+    MIN_PRECISION
 
 class MetricTypes(object):
     GAUGE = 'gauge'
@@ -61,6 +73,341 @@ log = logging.getLogger(__name__)
 # MetricsBucketAggregator constructor.
 RECENT_POINT_THRESHOLD_DEFAULT = 3600
 
+# Classes of malformed lines, counted separately and reported as the error tag of
+#  dogstatsd.parse_errors
+PARSE_ERROR_LINE = 'format'
+PARSE_ERROR_VALUE = 'value'
+PARSE_ERROR_SAMPLE_RATE = 'sample_rate'
+PARSE_ERROR_METRIC_TYPE = 'metric_type'
+PARSE_ERROR_EVENT = 'event'
+PARSE_ERROR_SERVICE_CHECK = 'service_check'
+# Seconds between two logged examples of the same class of malformed line
+PARSE_ERROR_LOG_INTERVAL = 60
+# Longest part of a malformed line quoted in the log
+PARSE_ERROR_LOG_LENGTH = 200
+
+# Returned for a value that is not a number, as any string can be a set value
+_INVALID_VALUE = object()
+
+# What unicode.splitlines breaks lines on besides \r and \n: control characters, and
+#  the last bytes of the UTF-8 encodings of U+0085, U+2028 and U+2029. Other characters
+#  end with those too, which only costs decoding their datagrams whole. Deleting them
+#  with str.translate is the quickest check for their presence, a regex takes 4-10x longer.
+_UNICODE_LINE_BREAK_BYTES = '\x0b\x0c\x1c\x1d\x1e\x85\xa8\xa9'
+# <name>:<value>|<type>[|@<sample_rate>][|#<tags>], the shape of nearly every line
+_SIMPLE_METRIC_LINE = re.compile(r'([^:]*):([^|:]*)\|([^|:]*)(?:\|@([^|:]*))?(?:\|#([^|]*))?\Z')
+# One <value>|<type>[|<metadata>...] of a multi-value line. Values are separated by a
+#  ':' followed by a field containing a '|', any other ':' belongs to the tags.
+_METRIC_DATUM = re.compile(r'([^|:]*)\|([^|]*?)((?:\|[^|]*?)*?)(?::(?=[^:|]*\|)|\Z)')
+
+
+# Default number of tagged series whose context is cached, and the approximate
+#  memory the cache may hold
+CONTEXT_CACHE_SIZE = 65536
+CONTEXT_CACHE_MAX_BYTES = 32 * 1024 * 1024
+# Rough cost of a cache entry besides its strings: dict slot, key and context tuples
+CONTEXT_CACHE_ENTRY_OVERHEAD = 240
+
+# Points per list yielded by MetricsBucketAggregator.flush_batches
+FLUSH_BATCH_SIZE = 1000
+
+
+class ContextCache(object):
+    """
+    A bounded cache from the raw name and tags of a metric line to its context.
+
+    LRU is approximated with two generations: entries go to the young generation and a
+    hit in the old one moves the entry back to the young one. When the young
+    generation is full, by entries or by its estimated size, it becomes the old one
+    and the previous old generation is dropped. So at most max_entries and about
+    max_bytes are held, and the entries evicted are those unused for a whole
+    generation, without the bookkeeping of an ordered dict on every hit.
+    """
+
+    def __init__(self, max_entries=CONTEXT_CACHE_SIZE, max_bytes=CONTEXT_CACHE_MAX_BYTES):
+        self.generation_entries = max(1, max_entries // 2)
+        self.generation_bytes = max(1, max_bytes // 2)
+        self.young = {}
+        self.young_bytes = 0
+        self.old = {}
+        self.old_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        context = self.young.get(key)
+        if context is None:
+            context = self.old.pop(key, None)
+            if context is None:
+                self.misses += 1
+                return None
+            self.old_bytes -= self._entry_size(key)
+            self.put(key, context)
+        self.hits += 1
+        return context
+
+    def put(self, key, context):
+        if len(self.young) >= self.generation_entries or self.young_bytes >= self.generation_bytes:
+            self.evictions += len(self.old)
+            self.old = self.young
+            self.old_bytes = self.young_bytes
+            self.young = {}
+            self.young_bytes = 0
+        self.young[key] = context
+        self.young_bytes += self._entry_size(key)
+
+    @staticmethod
+    def _entry_size(key):
+        # The raw tags are held twice: in the key and split up in the context
+        name, raw_tags = key
+        return len(name) + 2 * len(raw_tags or '') + CONTEXT_CACHE_ENTRY_OVERHEAD
+
+    def __len__(self):
+        return len(self.young) + len(self.old)
+
+    @property
+    def size_bytes(self):
+        return self.young_bytes + self.old_bytes
+
+
+def sum_internal_metrics(metric_lists):
+    """ Add up (name, value, metric_type, tags) tuples reported by several aggregators """
+    totals = {}
+    order = []
+    for metrics in metric_lists:
+        for name, value, metric_type, tags in metrics:
+            key = (name, metric_type, tags)
+            if key not in totals:
+                totals[key] = 0
+                order.append(key)
+            totals[key] += value
+    return [(name, totals[(name, metric_type, tags)], metric_type, tags)
+            for name, metric_type, tags in order]
+
+
+class ContextTable(object):
+    """
+    Interns contexts: each distinct context is given a small integer ID once, and
+    metric state is keyed and tracked by that ID. The context tuple is only looked up
+    again at flush. Released IDs are handed out again to new contexts.
+    """
+
+    def __init__(self):
+        # context -> ID
+        self.ids = {}
+        # ID -> context, None once released
+        self.contexts = []
+        self.free_ids = []
+        # metric name -> number of interned contexts with that name
+        self.count_by_name = {}
+
+    def intern(self, context):
+        context_id = self.ids.get(context)
+        if context_id is None:
+            if self.free_ids:
+                context_id = self.free_ids.pop()
+                self.contexts[context_id] = context
+            else:
+                context_id = len(self.contexts)
+                self.contexts.append(context)
+            self.ids[context] = context_id
+            name = context[0]
+            self.count_by_name[name] = self.count_by_name.get(name, 0) + 1
+        return context_id
+
+    def release(self, context_id):
+        context = self.contexts[context_id]
+        if context is not None:
+            del self.ids[context]
+            self.contexts[context_id] = None
+            self.free_ids.append(context_id)
+            name = context[0]
+            if self.count_by_name[name] > 1:
+                self.count_by_name[name] -= 1
+            else:
+                del self.count_by_name[name]
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class ExpiryWheel(object):
+    """
+    The last time each key was seen, with the keys also grouped in slots of `width`
+    seconds by that time. Keys not seen since a cutoff are found by looking only at
+    the slots before it, whatever the number of keys seen since.
+    """
+
+    def __init__(self, width):
+        self.width = width
+        # key -> time
+        self.times = {}
+        # slot start -> set of the keys whose time falls in the slot
+        self.slots = {}
+
+    def _slot(self, timestamp):
+        return timestamp - (timestamp % self.width)
+
+    def __setitem__(self, key, timestamp):
+        times = self.times
+        slot = self._slot(timestamp)
+        if key in times:
+            old_slot = self._slot(times[key])
+            times[key] = timestamp
+            if old_slot == slot:
+                return
+            self._unlink(key, old_slot)
+        else:
+            times[key] = timestamp
+        keys = self.slots.get(slot)
+        if keys is None:
+            keys = self.slots[slot] = set()
+        keys.add(key)
+
+    def _unlink(self, key, slot):
+        keys = self.slots[slot]
+        keys.discard(key)
+        if not keys:
+            del self.slots[slot]
+
+    def setdefault(self, key, timestamp):
+        if key not in self.times:
+            self[key] = timestamp
+        return self.times[key]
+
+    def pop(self, key, default=None):
+        if key not in self.times:
+            return default
+        timestamp = self.times.pop(key)
+        self._unlink(key, self._slot(timestamp))
+        return timestamp
+
+    def get(self, key, default=None):
+        return self.times.get(key, default)
+
+    def __getitem__(self, key):
+        return self.times[key]
+
+    def __contains__(self, key):
+        return key in self.times
+
+    def __iter__(self):
+        return iter(self.times)
+
+    def __len__(self):
+        return len(self.times)
+
+    def pop_expired(self, cutoff):
+        """ Remove and return the keys last seen before cutoff """
+        times = self.times
+        expired = []
+        for slot in [slot for slot in self.slots if slot < cutoff]:
+            keys = self.slots[slot]
+            if slot + self.width <= cutoff:
+                del self.slots[slot]
+                expired.extend(keys)
+                for key in keys:
+                    del times[key]
+            else:
+                # The slot holding the cutoff, only part of it is expired
+                for key in [key for key in keys if times[key] < cutoff]:
+                    self._unlink(key, slot)
+                    del times[key]
+                    expired.append(key)
+        return expired
+
+
+# Once a cardinality cap is reached, points of new contexts are folded into an
+#  overflow context of their metric name, tagged with OVERFLOW_TAG. When the global
+#  cap is reached, into a context named GLOBAL_OVERFLOW_NAME for their metric type.
+OVERFLOW_TAG = 'dogstatsd_overflow:true'
+GLOBAL_OVERFLOW_NAME = 'dogstatsd.overflow'
+# Metric names whose rejected contexts are counted apart, the others are counted together
+MAX_REJECTED_NAMES = 100
+REJECTED_OTHER_NAMES = '_other'
+
+# How a MetricsBucketAggregator stores counters and gauges: one metric object per
+#  context and bucket, or array columns per bucket indexed by context ID
+STORAGE_OBJECTS = 'objects'
+STORAGE_COLUMNAR = 'columnar'
+STORAGES = (STORAGE_OBJECTS, STORAGE_COLUMNAR)
+
+
+class ColumnBucket(object):
+    """
+    The counters and gauges of one bucket, as array('d') columns indexed by context
+    ID. A zero sample time means the context has no value of that type in the bucket.
+    """
+    __slots__ = ('counter_ids', 'counters', 'counter_times',
+                 'gauge_ids', 'gauges', 'gauge_times')
+
+    def __init__(self):
+        # IDs with a value in this bucket, in the order they were first sampled
+        self.counter_ids = []
+        self.counters = array('d')
+        self.counter_times = array('d')
+        self.gauge_ids = []
+        self.gauges = array('d')
+        self.gauge_times = array('d')
+
+    def grow(self, context_id):
+        """ Make room for context_id in every column """
+        size = len(self.counters)
+        extra = array('d', [0.0]) * (max(context_id + 1, 2 * size, 16) - size)
+        self.counters.extend(extra)
+        self.counter_times.extend(extra)
+        self.gauges.extend(extra)
+        self.gauge_times.extend(extra)
+
+    def __contains__(self, context_id):
+        return context_id < len(self.counters) and \
+            (self.counter_times[context_id] != 0 or self.gauge_times[context_id] != 0)
+
+    def merge(self, other, metric_by_id=()):
+        """
+        Add the values of a bucket with the same start, sampled after these. The
+        contexts in metric_by_id were sampled first with another type, and keep it.
+        """
+        if len(other.counters) > len(self.counters):
+            self.grow(len(other.counters) - 1)
+        for context_id in other.counter_ids:
+            if context_id in metric_by_id or self.gauge_times[context_id]:
+                continue
+            if not self.counter_times[context_id]:
+                self.counter_ids.append(context_id)
+            self.counters[context_id] += other.counters[context_id]
+            self.counter_times[context_id] = other.counter_times[context_id]
+        for context_id in other.gauge_ids:
+            if context_id in metric_by_id or self.counter_times[context_id]:
+                continue
+            if not self.gauge_times[context_id]:
+                self.gauge_ids.append(context_id)
+            self.gauges[context_id] = other.gauges[context_id]
+            self.gauge_times[context_id] = other.gauge_times[context_id]
+
+
+class BucketGeneration(object):
+    """
+    What the thread submitting packets to a MetricsBucketAggregator writes between two
+    flushes. A flush swaps in a new generation and takes the retired one whole, so
+    the two threads never write to the same dicts.
+    """
+    __slots__ = ('metric_by_bucket', 'columns_by_bucket', 'current_bucket', 'current_mbc',
+                 'current_columns', 'num_discarded_old_points', 'discarded_ids')
+
+    def __init__(self):
+        # bucket start -> context ID -> metric
+        self.metric_by_bucket = {}
+        # With columnar storage, bucket start -> ColumnBucket, for the same buckets
+        self.columns_by_bucket = {}
+        self.current_bucket = None
+        self.current_mbc = None
+        self.current_columns = None
+        self.num_discarded_old_points = 0
+        # Context IDs whose only points were discarded, for the flush to track
+        self.discarded_ids = []
+
 
 class Infinity(Exception):
     pass
@@ -70,32 +417,93 @@ class UnknownValue(Exception):
     pass
 
 
+class MetricDescriptor(object):
+    """
+    What every metric of one context shares: its formatter, name, tags, hostname and
+    device_name. Aggregators create one per context and hand it to the metric of
+    each bucket, instead of every metric holding its own references.
+    """
+    __slots__ = ('formatter', 'name', 'tags', 'hostname', 'device_name')
+
+    def __init__(self, formatter, name, tags, hostname, device_name):
+        self.formatter = formatter
+        self.name = name
+        self.tags = tags
+        self.hostname = hostname
+        self.device_name = device_name
+
+
 class Metric(object):
     """
     A base metric class that accepts points, slices them into time intervals
     and performs roll-ups within those intervals.
+
+    Metrics use __slots__ and keep what describes their context in a shared
+    MetricDescriptor, so a live series costs a few dozen bytes.
     """
+    __slots__ = ('descriptor', 'last_sample_time')
+
+    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
+        self._init(MetricDescriptor(formatter, name, tags, hostname, device_name), extra_config)
+
+    @classmethod
+    def from_descriptor(cls, descriptor, extra_config=None):
+        """ A metric of the context that descriptor describes """
+        metric = cls.__new__(cls)
+        metric._init(descriptor, extra_config)
+        return metric
+
+    def _init(self, descriptor, extra_config):
+        self.descriptor = descriptor
+        self.last_sample_time = None
+
+    formatter = property(lambda self: self.descriptor.formatter)
+    name = property(lambda self: self.descriptor.name)
+    tags = property(lambda self: self.descriptor.tags)
+    hostname = property(lambda self: self.descriptor.hostname)
+    device_name = property(lambda self: self.descriptor.device_name)
 
     def sample(self, value, sample_rate, timestamp=None):
         """ Add a point to the given metric. """
         raise NotImplementedError()
 
     def flush(self, timestamp, interval):
-        """ Flush all metrics up to the given timestamp. """
+        """
+        Flush all metrics up to the given timestamp. The metric is left empty, ready to
+        take the samples of a later bucket.
+        """
         raise NotImplementedError()
 
+    def merge(self, other):
+        """ Fold the unflushed state of another metric of the same context into this one. """
+        raise NotImplementedError()
+
+    def _merge_last_sample_time(self, other):
+        if other.last_sample_time is not None and \
+                (self.last_sample_time is None or other.last_sample_time > self.last_sample_time):
+            self.last_sample_time = other.last_sample_time
+
+    def _format(self, metric, value, timestamp, metric_type, interval):
+        descriptor = self.descriptor
+        return descriptor.formatter(
+            metric=metric,
+            value=value,
+            timestamp=timestamp,
+            tags=descriptor.tags,
+            hostname=descriptor.hostname,
+            device_name=descriptor.device_name,
+            metric_type=metric_type,
+            interval=interval,
+        )
+
 
 class Gauge(Metric):
     """ A metric that tracks a value at particular points in time. """
+    __slots__ = ('value', 'timestamp')
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
-        self.name = name
+    def _init(self, descriptor, extra_config):
+        Metric._init(self, descriptor, extra_config)
         self.value = None
-        self.tags = tags
-        self.hostname = hostname
-        self.device_name = device_name
-        self.last_sample_time = None
         self.timestamp = time()
 
     def sample(self, value, sample_rate, timestamp=None):
@@ -103,19 +511,18 @@ class Gauge(Metric):
         self.last_sample_time = time()
         self.timestamp = timestamp
 
+    def merge(self, other):
+        # Last write wins, by sample timestamp
+        if other.value is not None and \
+                (self.value is None or (other.timestamp or 0) >= (self.timestamp or 0)):
+            self.value = other.value
+            self.timestamp = other.timestamp
+        self._merge_last_sample_time(other)
 
     def flush(self, timestamp, interval):
         if self.value is not None:
-            res = [self.formatter(
-                metric=self.name,
-                timestamp=self.timestamp or timestamp,
-                value=self.value,
-                tags=self.tags,
-                hostname=self.hostname,
-                device_name=self.device_name,
-                metric_type=MetricTypes.GAUGE,
-                interval=interval,
-            )]
+            res = [self._format(self.descriptor.name, self.value, self.timestamp or timestamp,
+                                MetricTypes.GAUGE, interval)]
             self.value = None
             return res
 
@@ -128,19 +535,12 @@ class BucketGauge(Gauge):
     opposed to the time that the sample was collected.
 
     """
+    __slots__ = ()
 
     def flush(self, timestamp, interval):
         if self.value is not None:
-            res = [self.formatter(
-                metric=self.name,
-                timestamp=timestamp,
-                value=self.value,
-                tags=self.tags,
-                hostname=self.hostname,
-                device_name=self.device_name,
-                metric_type=MetricTypes.GAUGE,
-                interval=interval,
-            )]
+            res = [self._format(self.descriptor.name, self.value, timestamp,
+                                MetricTypes.GAUGE, interval)]
             self.value = None
             return res
 
@@ -149,49 +549,38 @@ class BucketGauge(Gauge):
 
 class Count(Metric):
     """ A metric that tracks a count. """
+    __slots__ = ('value',)
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
-        self.name = name
+    def _init(self, descriptor, extra_config):
+        Metric._init(self, descriptor, extra_config)
         self.value = None
-        self.tags = tags
-        self.hostname = hostname
-        self.device_name = device_name
-        self.last_sample_time = None
 
     def sample(self, value, sample_rate, timestamp=None):
         self.value = (self.value or 0) + value
         self.last_sample_time = time()
 
+    def merge(self, other):
+        if other.value is not None:
+            self.value = (self.value or 0) + other.value
+        self._merge_last_sample_time(other)
+
     def flush(self, timestamp, interval):
         if self.value is None:
             return []
         try:
-            return [self.formatter(
-                metric=self.name,
-                value=self.value,
-                timestamp=timestamp,
-                tags=self.tags,
-                hostname=self.hostname,
-                device_name=self.device_name,
-                metric_type=MetricTypes.COUNT,
-                interval=interval,
-            )]
+            return [self._format(self.descriptor.name, self.value, timestamp,
+                                 MetricTypes.COUNT, interval)]
         finally:
             self.value = None
 
 class MonotonicCount(Metric):
+    __slots__ = ('prev_counter', 'curr_counter', 'count')
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
-        self.name = name
-        self.tags = tags
-        self.hostname = hostname
-        self.device_name = device_name
+    def _init(self, descriptor, extra_config):
+        Metric._init(self, descriptor, extra_config)
         self.prev_counter = None
         self.curr_counter = None
         self.count = None
-        self.last_sample_time = None
 
     def sample(self, value, sample_rate, timestamp=None):
         if self.curr_counter is None:
@@ -207,20 +596,24 @@ class MonotonicCount(Metric):
 
         self.last_sample_time = time()
 
+    def merge(self, other):
+        # Each side counted the increases between its own samples. The side sampled
+        #  last carries on the counter, by sample time like Gauge.
+        if other.count is not None:
+            self.count = (self.count or 0) + other.count
+        if other.curr_counter is not None and \
+                (self.curr_counter is None or
+                 (other.last_sample_time or 0) >= (self.last_sample_time or 0)):
+            self.prev_counter = other.prev_counter
+            self.curr_counter = other.curr_counter
+        self._merge_last_sample_time(other)
+
     def flush(self, timestamp, interval):
         if self.count is None:
             return []
         try:
-            return [self.formatter(
-                hostname=self.hostname,
-                device_name=self.device_name,
-                tags=self.tags,
-                metric=self.name,
-                value=self.count,
-                timestamp=timestamp,
-                metric_type=MetricTypes.COUNT,
-                interval=interval
-            )]
+            return [self._format(self.descriptor.name, self.count, timestamp,
+                                 MetricTypes.COUNT, interval)]
         finally:
             self.prev_counter = self.curr_counter
             self.curr_counter = None
@@ -229,74 +622,153 @@ class MonotonicCount(Metric):
 
 class Counter(Metric):
     """ A metric that tracks a counter value. """
+    __slots__ = ('value',)
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
-        self.name = name
+    def _init(self, descriptor, extra_config):
+        Metric._init(self, descriptor, extra_config)
         self.value = 0
-        self.tags = tags
-        self.hostname = hostname
-        self.device_name = device_name
-        self.last_sample_time = None
 
     def sample(self, value, sample_rate, timestamp=None):
         self.value += value * int(1 / sample_rate)
         self.last_sample_time = time()
 
+    def merge(self, other):
+        self.value += other.value
+        self._merge_last_sample_time(other)
+
     def flush(self, timestamp, interval):
         try:
             value = self.value / interval
-            return [self.formatter(
-                metric=self.name,
-                value=value,
-                timestamp=timestamp,
-                tags=self.tags,
-                hostname=self.hostname,
-                device_name=self.device_name,
-                metric_type=MetricTypes.RATE,
-                interval=interval,
-            )]
+            return [self._format(self.descriptor.name, value, timestamp,
+                                 MetricTypes.RATE, interval)]
         finally:
             self.value = 0
 
 DEFAULT_HISTOGRAM_AGGREGATES = ['max', 'median', 'avg', 'count']
 DEFAULT_HISTOGRAM_PERCENTILES = [0.95]
 
+# Histograms keep every sample until flush, or summarize them in a DDSketch
+HISTOGRAM_EXACT = 'exact'
+HISTOGRAM_SKETCH = 'sketch'
+HISTOGRAM_BACKENDS = (HISTOGRAM_EXACT, HISTOGRAM_SKETCH)
+
 class Histogram(Metric):
     """ A metric to track the distribution of a set of values. """
+    __slots__ = ('count', 'samples', 'integral', 'aggregates', 'percentiles')
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
-        self.name = name
+    def _init(self, descriptor, extra_config):
+        Metric._init(self, descriptor, extra_config)
+        self._configure(extra_config)
+        self.samples = array('d')
+        # Whether every sample was an int, so that min, max, median and percentiles are
+        #  flushed as ints like the samples and not as the floats the array holds
+        self.integral = True
+
+    def _configure(self, extra_config):
         self.count = 0
-        self.samples = []
         self.aggregates = extra_config['aggregates'] if \
             extra_config is not None and extra_config.get('aggregates') is not None \
             else DEFAULT_HISTOGRAM_AGGREGATES
         self.percentiles = extra_config['percentiles'] if \
             extra_config is not None and extra_config.get('percentiles') is not None \
             else DEFAULT_HISTOGRAM_PERCENTILES
-        self.tags = tags
-        self.hostname = hostname
-        self.device_name = device_name
-        self.last_sample_time = None
 
     def sample(self, value, sample_rate, timestamp=None):
         self.count += int(1 / sample_rate)
         self.samples.append(value)
+        if self.integral and not isinstance(value, (int, long)):
+            self.integral = False
         self.last_sample_time = time()
 
+    def merge(self, other):
+        self.count += other.count
+        self.samples.extend(other.samples)
+        self.integral = self.integral and other.integral
+        self._merge_last_sample_time(other)
+
     def flush(self, ts, interval):
         if not self.count:
             return []
 
-        self.samples.sort()
-        length = len(self.samples)
+        samples = sorted(self.samples)
+        if self.integral:
+            samples = [int(sample) for sample in samples]
+        length = len(samples)
+        try:
+            return self._flush_summary(ts, interval, length, samples[0], samples[-1],
+                                       sum(samples) / float(length), samples.__getitem__)
+        finally:
+            # Reset our state.
+            del self.samples[:]
+            self.count = 0
+            self.integral = True
 
-        min_ = self.samples[0]
-        max_ = self.samples[-1]
-        med = self.samples[int(round(length/2 - 1))]
-        avg = sum(self.samples) / float(length)
+    @classmethod
+    def flush_all(cls, histograms, ts, interval):
+        """
+        Flush many histograms at once. With NumPy, the min, max and sum of every histogram
+        are reduced in one pass over all their samples, and the median and percentiles of
+        each are selected with a partition instead of a sort.
+        """
+        if numpy is None:
+            metrics = []
+            for histogram in histograms:
+                metrics += histogram.flush(ts, interval)
+            return metrics
+
+        histograms = [histogram for histogram in histograms if histogram.count]
+        if not histograms:
+            return []
+        buffers = [numpy.frombuffer(histogram.samples, dtype=numpy.float64) for histogram in histograms]
+        lengths = [len(histogram.samples) for histogram in histograms]
+        offsets = numpy.cumsum([0] + lengths[:-1])
+        samples = numpy.concatenate(buffers)
+        mins = numpy.minimum.reduceat(samples, offsets).tolist()
+        maxes = numpy.maximum.reduceat(samples, offsets).tolist()
+        sums = numpy.add.reduceat(samples, offsets).tolist()
+
+        # Histograms with as many samples and the same percentiles read the same ranks:
+        #  stack their samples as rows and select those ranks with a single partition
+        groups = {}
+        for i, histogram in enumerate(histograms):
+            groups.setdefault((lengths[i], tuple(histogram.percentiles)), []).append(i)
+        selected = [None] * len(histograms)
+        for (length, percentiles), members in groups.iteritems():
+            # The indices Histogram.flush reads in the sorted samples, negative ones included
+            ranks = sorted(set(rank % length for rank in
+                               [int(round(length/2 - 1))] +
+                               [int(round(p * length - 1)) for p in percentiles]))
+            if len(members) == 1:
+                rows = [numpy.partition(buffers[members[0]], ranks)[ranks].tolist()]
+            else:
+                stacked = samples[offsets[members, None] + numpy.arange(length)]
+                stacked.partition(ranks, axis=1)
+                rows = stacked[:, ranks].tolist()
+            for i, row in zip(members, rows):
+                selected[i] = dict(zip(ranks, row))
+
+        # The arrays are emptied below, drop the views on their memory first
+        del buffers, samples
+        metrics = []
+        for i, histogram in enumerate(histograms):
+            length = lengths[i]
+            min_, max_ = mins[i], maxes[i]
+            value_at = lambda rank: selected[i][rank % length]
+            if histogram.integral:
+                min_, max_ = int(min_), int(max_)
+                value_at = lambda rank: int(selected[i][rank % length])
+            try:
+                metrics += histogram._flush_summary(ts, interval, length, min_, max_,
+                                                    sums[i] / float(length), value_at)
+            finally:
+                del histogram.samples[:]
+                histogram.count = 0
+                histogram.integral = True
+        return metrics
+
+    def _flush_summary(self, ts, interval, length, min_, max_, avg, value_at):
+        """ The aggregates and percentiles of length values, value_at(i) being the i-th smallest """
+        med = value_at(int(round(length/2 - 1)))
 
         aggregators = [
             ('min', min_, MetricTypes.GAUGE),
@@ -312,88 +784,151 @@ class Histogram(Metric):
             if agg_name in self.aggregates
             ]
 
-        metrics = [self.formatter(
-            hostname=self.hostname,
-            device_name=self.device_name,
-            tags=self.tags,
-            metric='%s.%s' % (self.name, suffix),
-            value=value,
-            timestamp=ts,
-            metric_type=metric_type,
-            interval=interval) for suffix, value, metric_type in metric_aggrs
-                   ]
+        name = self.descriptor.name
+        metrics = [self._format('%s.%s' % (name, suffix), value, ts, metric_type, interval)
+                   for suffix, value, metric_type in metric_aggrs]
 
+        descriptor = self.descriptor
         for p in self.percentiles:
-            val = self.samples[int(round(p * length - 1))]
-            name = '%s.%spercentile' % (self.name, int(p * 100))
-            metrics.append(self.formatter(
-                hostname=self.hostname,
-                tags=self.tags,
-                metric=name,
+            val = value_at(int(round(p * length - 1)))
+            metrics.append(descriptor.formatter(
+                hostname=descriptor.hostname,
+                tags=descriptor.tags,
+                metric='%s.%spercentile' % (name, int(p * 100)),
                 value=val,
                 timestamp=ts,
                 metric_type=MetricTypes.GAUGE,
                 interval=interval,
             ))
 
-        # Reset our state.
-        self.samples = []
-        self.count = 0
-
         return metrics
 
 
+class SketchHistogram(Histogram):
+    """
+    A histogram that keeps its values in a DDSketch instead of a list. Its memory and
+    flush cost do not grow with the number of samples; min, max and avg stay exact and
+    the median and percentiles are within the sketch's relative error.
+    """
+    __slots__ = ('sketch',)
+
+    def _init(self, descriptor, extra_config):
+        Metric._init(self, descriptor, extra_config)
+        self._configure(extra_config)
+        self.samples = None
+        relative_error = extra_config.get('relative_error') if extra_config is not None else None
+        self.sketch = DDSketch(relative_error or DEFAULT_RELATIVE_ERROR)
+
+    def sample(self, value, sample_rate, timestamp=None):
+        self.count += int(1 / sample_rate)
+        self.sketch.add(value)
+        self.last_sample_time = time()
+
+    def merge(self, other):
+        self.count += other.count
+        self.sketch.merge(other.sketch)
+        self._merge_last_sample_time(other)
+
+    def flush(self, ts, interval):
+        sketch = self.sketch
+        if not self.count or not sketch.count:
+            self.count = 0
+            return []
+
+        length = sketch.count
+        try:
+            return self._flush_summary(ts, interval, length, sketch.min, sketch.max,
+                                       sketch.sum / float(length), sketch.value_at_rank)
+        finally:
+            sketch.clear()
+            self.count = 0
+
+
 class Set(Metric):
     """ A metric to track the number of unique elements in a set. """
+    __slots__ = ('values',)
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
-        self.name = name
-        self.tags = tags
-        self.hostname = hostname
-        self.device_name = device_name
+    def _init(self, descriptor, extra_config):
+        Metric._init(self, descriptor, extra_config)
         self.values = set()
-        self.last_sample_time = None
 
     def sample(self, value, sample_rate, timestamp=None):
         self.values.add(value)
         self.last_sample_time = time()
 
+    def merge(self, other):
+        self.values |= other.values
+        self._merge_last_sample_time(other)
+
     def flush(self, timestamp, interval):
         if not self.values:
             return []
         try:
-            return [self.formatter(
-                hostname=self.hostname,
-                device_name=self.device_name,
-                tags=self.tags,
-                metric=self.name,
-                value=len(self.values),
-                timestamp=timestamp,
-                metric_type=MetricTypes.GAUGE,
-                interval=interval,
-            )]
+            return [self._format(self.descriptor.name, len(self.values), timestamp,
+                                 MetricTypes.GAUGE, interval)]
+        finally:
+            self.values.clear()
+
+
+# Sets keep every member until flush, or count them in a HyperLogLog
+SET_EXACT = 'exact'
+SET_HLL = 'hll'
+SET_BACKENDS = (SET_EXACT, SET_HLL)
+
+
+class HyperLogLogSet(Metric):
+    """
+    A set that estimates its number of unique elements with a HyperLogLog instead of
+    keeping them, in at most 2 ** precision bytes.
+    """
+    __slots__ = ('hll',)
+
+    def _init(self, descriptor, extra_config):
+        Metric._init(self, descriptor, extra_config)
+        precision = extra_config.get('precision') if extra_config is not None else None
+        self.hll = HyperLogLog(precision or DEFAULT_PRECISION)
+
+    def sample(self, value, sample_rate, timestamp=None):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        elif not isinstance(value, str):
+            value = str(value)
+        self.hll.add(value)
+        self.last_sample_time = time()
+
+    def merge(self, other):
+        self.hll.merge(other.hll)
+        self._merge_last_sample_time(other)
+
+    def flush(self, timestamp, interval):
+        cardinality = len(self.hll)
+        if not cardinality:
+            return []
+        try:
+            return [self._format(self.descriptor.name, cardinality, timestamp,
+                                 MetricTypes.GAUGE, interval)]
         finally:
-            self.values = set()
+            self.hll.clear()
 
 
 class Rate(Metric):
     """ Track the rate of metrics over each flush interval """
+    __slots__ = ('samples',)
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
-        self.name = name
-        self.tags = tags
-        self.hostname = hostname
-        self.device_name = device_name
+    def _init(self, descriptor, extra_config):
+        Metric._init(self, descriptor, extra_config)
         self.samples = []
-        self.last_sample_time = None
 
     def sample(self, value, sample_rate, timestamp=None):
         ts = time()
         self.samples.append((int(ts), value))
         self.last_sample_time = ts
 
+    def merge(self, other):
+        # The rate is read off the last two samples of either side, in time order
+        self.samples = sorted(self.samples + other.samples, key=lambda sample: sample[0])
+        self._merge_last_sample_time(other)
+
     def _rate(self, sample1, sample2):
         interval = sample2[0] - sample1[0]
         if interval == 0:
@@ -416,16 +951,8 @@ class Rate(Metric):
             except Exception:
                 return []
 
-            return [self.formatter(
-                hostname=self.hostname,
-                device_name=self.device_name,
-                tags=self.tags,
-                metric=self.name,
-                value=val,
-                timestamp=timestamp,
-                metric_type=MetricTypes.GAUGE,
-                interval=interval
-            )]
+            return [self._format(self.descriptor.name, val, timestamp,
+                                 MetricTypes.GAUGE, interval)]
         finally:
             self.samples = self.samples[-1:]
 
@@ -439,7 +966,9 @@ class Aggregator(object):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
                  formatter=None, recent_point_threshold=None,
                  histogram_aggregates=None, histogram_percentiles=None,
-                 utf8_decoding=False):
+                 utf8_decoding=False, context_cache_size=None,
+                 histogram_backend=HISTOGRAM_EXACT, histogram_relative_error=None,
+                 set_backend=SET_EXACT, set_precision=None):
         self.events = []
         self.service_checks = []
         self.total_count = 0
@@ -460,11 +989,56 @@ class Aggregator(object):
             Histogram: {
                 'aggregates': histogram_aggregates,
                 'percentiles': histogram_percentiles
+            },
+            SketchHistogram: {
+                'aggregates': histogram_aggregates,
+                'percentiles': histogram_percentiles,
+                'relative_error': histogram_relative_error
+            },
+            HyperLogLogSet: {
+                'precision': set_precision
             }
         }
-
+        if histogram_backend not in HISTOGRAM_BACKENDS:
+            raise ValueError('Unknown histogram backend %s, expected one of %s' %
+                             (histogram_backend, ', '.join(HISTOGRAM_BACKENDS)))
+        if histogram_relative_error is not None and not 0 < histogram_relative_error < 1:
+            raise ValueError('Histogram relative error must be between 0 and 1, got %s' %
+                             histogram_relative_error)
+        # What histograms and timers are aggregated with
+        self.histogram_class = SketchHistogram if histogram_backend == HISTOGRAM_SKETCH else Histogram
+        if set_backend not in SET_BACKENDS:
+            raise ValueError('Unknown set backend %s, expected one of %s' %
+                             (set_backend, ', '.join(SET_BACKENDS)))
+        if set_precision is not None and not MIN_PRECISION <= set_precision <= MAX_PRECISION:
+            raise ValueError('Set precision must be between %d and %d, got %s' %
+                             (MIN_PRECISION, MAX_PRECISION, set_precision))
+        self.set_class = HyperLogLogSet if set_backend == SET_HLL else Set
+
+        # Clients MUST always send UTF-8 encoded content. Lines are split and parsed as
+        #  bytes all the same, see _decode.
         self.utf8_decoding = utf8_decoding
 
+        # PARSE_ERROR_* -> number of lines skipped, and when one was last logged
+        self.parse_errors = {}
+        self.parse_error_logged_at = {}
+
+        if context_cache_size is None:
+            context_cache_size = CONTEXT_CACHE_SIZE
+        self.context_cache = ContextCache(context_cache_size) if context_cache_size > 0 else None
+
+    def _decode(self, field):
+        """
+        A field of a line split as bytes, decoded from UTF-8 when utf8_decoding is set.
+        Every separator of the statsd format is ASCII, which UTF-8 never uses inside
+        a multi-byte character, so this is the very text decoding the whole datagram
+        gives, invalid bytes included. Only the fields that are kept get decoded:
+        names and tags once per context, on a context cache miss, and set members.
+        """
+        if self.utf8_decoding and field.__class__ is str:
+            return unicode(field, 'utf-8', errors='replace')
+        return field
+
     def packets_per_second(self, interval):
         if interval == 0:
             return 0
@@ -536,6 +1110,142 @@ class Aggregator(object):
 
         return parsed_packets
 
+    def parse_metric_line(self, line):
+        """
+        Parse a metric line in a single pass, straight into the contexts metrics are
+        keyed by: (name, sorted unique tags, hostname, device_name), with the host and
+        device magic tags applied. Returns a list of
+        (context, value, metric_type, sample_rate), one per value of the line.
+        """
+        parsed = self._parse_metric_line(line, self._metric_context)
+        if parsed.__class__ is not list:
+            raise Exception('Unparseable metric packet, bad %s: %s' % (parsed, line))
+        return parsed
+
+    def _parse_metric_line(self, line, resolve_context):
+        # resolve_context(name, raw_tags, metric_type) makes the first item of each tuple returned.
+        #  Returns the PARSE_ERROR_* class of a malformed line instead of raising, so
+        #  that bad lines cost no more than good ones.
+        metric_types = self.metric_type_to_class
+        match = _SIMPLE_METRIC_LINE.match(line)
+        if match is not None:
+            name, raw_value, metric_type, raw_sample_rate, raw_tags = match.groups()
+            if metric_type not in metric_types:
+                return PARSE_ERROR_METRIC_TYPE
+            value = self._parse_metric_value(raw_value, metric_type)
+            if value is _INVALID_VALUE:
+                return PARSE_ERROR_VALUE
+            sample_rate = 1
+            if raw_sample_rate is not None:
+                sample_rate = self._parse_sample_rate(raw_sample_rate)
+                if sample_rate is None:
+                    return PARSE_ERROR_SAMPLE_RATE
+            return [(resolve_context(name, raw_tags, metric_type), value, metric_type, sample_rate)]
+
+        # Multi-value lines, metadata in another order, or garbage
+        name_end = line.find(':')
+        if name_end < 0:
+            return PARSE_ERROR_LINE
+        name = line[:name_end]
+        pos = name_end + 1
+        end = len(line)
+        fields = []
+        while pos < end or not fields:
+            match = _METRIC_DATUM.match(line, pos)
+            if match is None:
+                return PARSE_ERROR_LINE
+            raw_value, metric_type, metadata = match.groups()
+            if metric_type not in metric_types:
+                return PARSE_ERROR_METRIC_TYPE
+            value = self._parse_metric_value(raw_value, metric_type)
+            if value is _INVALID_VALUE:
+                return PARSE_ERROR_VALUE
+            sample_rate = 1
+            raw_tags = None
+            if metadata:
+                for m in metadata[1:].split('|'):
+                    if m[:1] == '@':
+                        sample_rate = self._parse_sample_rate(m[1:])
+                        if sample_rate is None:
+                            return PARSE_ERROR_SAMPLE_RATE
+                    elif m[:1] == '#':
+                        raw_tags = m[1:]
+                    elif not m:
+                        return PARSE_ERROR_LINE
+            fields.append((name, raw_tags, value, metric_type, sample_rate))
+            pos = match.end()
+        # Only resolved once the whole line is known to be valid
+        return [(resolve_context(name, raw_tags, metric_type), value, metric_type, sample_rate)
+                for name, raw_tags, value, metric_type, sample_rate in fields]
+
+    def _metric_context(self, name, raw_tags, metric_type=None):
+        if raw_tags is None:
+            return (self._decode(name), (), self.hostname, None)
+        cache = self.context_cache
+        if cache is None:
+            return self._build_metric_context(name, raw_tags)
+        key = (name, raw_tags)
+        context = cache.get(key)
+        if context is None:
+            context = self._build_metric_context(name, raw_tags)
+            cache.put(key, context)
+        return context
+
+    def _build_metric_context(self, name, raw_tags):
+        name = self._decode(name)
+        if raw_tags is None:
+            return (name, (), self.hostname, None)
+        # Decoded first, non-ASCII tags sort differently as bytes
+        raw_tags = self._decode(raw_tags)
+        tags = sorted(set(raw_tags.split(',')))
+        hostname = self.hostname
+        device_name = None
+        if 'host:' in raw_tags or 'device:' in raw_tags:
+            # Magic tags override the hostname and device_name, the last one wins
+            kept = []
+            for tag in tags:
+                if tag.startswith('host:'):
+                    hostname = tag[5:]
+                elif tag.startswith('device:'):
+                    device_name = tag[7:]
+                else:
+                    kept.append(tag)
+            tags = kept
+        return (name, tuple(tags), hostname, device_name)
+
+    def _parse_metric_value(self, raw_value, metric_type):
+        if metric_type in self.ALLOW_STRINGS:
+            return self._decode(raw_value)
+        # Try to cast as an int first to avoid precision issues, then as a float.
+        #  int() never accepts a '.', so decimals skip straight to float().
+        if '.' not in raw_value:
+            try:
+                return int(raw_value)
+            except ValueError:
+                pass
+        try:
+            return float(raw_value)
+        except ValueError:
+            pass
+        # Digits and spaces of other scripts only parse once decoded
+        decoded = self._decode(raw_value)
+        if decoded is not raw_value:
+            return self._parse_metric_value(decoded, metric_type)
+        return _INVALID_VALUE
+
+    def _parse_sample_rate(self, raw_sample_rate):
+        try:
+            sample_rate = float(raw_sample_rate)
+        except ValueError:
+            decoded = self._decode(raw_sample_rate)
+            if decoded is raw_sample_rate:
+                return None
+            return self._parse_sample_rate(decoded)
+        # Counters and histograms scale by 1 / sample_rate
+        if not 0 < sample_rate <= 1:
+            return None
+        return sample_rate
+
     def _unescape_sc_content(self, string):
         return string.replace('\\n', '\n').replace('m\:', 'm:')
 
@@ -620,34 +1330,71 @@ class Aggregator(object):
         except (IndexError, ValueError):
             raise Exception(u'Unparseable service check packet: %s' % packet)
 
-    def submit_packets(self, packets):
-        # We should probably consider that packets are always encoded
-        # in utf8, but decoding all packets has an perf overhead of 7%
-        # So we let the user decide if we wants utf8 by default
-        # Keep a very conservative approach anyhow
-        # Clients MUST always send UTF-8 encoded content
-        if self.utf8_decoding:
+    def split_packet_lines(self, packets):
+        """
+        The lines of a datagram, as bytes: with utf8_decoding, the fields kept are
+        decoded one by one, see _decode. Only datagrams that may hold line breaks their
+        decoded text splits on but their bytes do not are decoded whole.
+        """
+        if self.utf8_decoding and \
+                len(packets.translate(None, _UNICODE_LINE_BREAK_BYTES)) != len(packets):
             packets = unicode(packets, 'utf-8', errors='replace')
+        return packets.splitlines()
 
-        for packet in packets.splitlines():
-            if not packet.strip():
+    def submit_packets(self, packets):
+        """ Submit every line of a datagram. Malformed lines are skipped and counted. """
+        for packet in self.split_packet_lines(packets):
+            if not packet or packet.isspace():
                 continue
 
             if packet.startswith('_e'):
+                try:
+                    event = self.parse_event_packet(self._decode(packet))
+                except Exception:
+                    self.count_parse_error(PARSE_ERROR_EVENT, packet)
+                    continue
                 self.event_count += 1
-                event = self.parse_event_packet(packet)
                 self.event(**event)
             elif packet.startswith('_sc'):
+                try:
+                    service_check = self.parse_sc_packet(self._decode(packet))
+                except Exception:
+                    self.count_parse_error(PARSE_ERROR_SERVICE_CHECK, packet)
+                    continue
                 self.service_check_count += 1
-                service_check = self.parse_sc_packet(packet)
                 self.service_check(**service_check)
             else:
-                parsed_packets = self.parse_metric_packet(packet)
-                for name, value, mtype, tags, sample_rate in parsed_packets:
-                    hostname, device_name, tags = self._extract_magic_tags(tags)
-                    self.submit_metric(name, value, mtype, tags=tags, hostname=hostname,
-                                       device_name=device_name, sample_rate=sample_rate)
-                self.count += 1
+                error = self.submit_metric_line(packet)
+                if error is None:
+                    self.count += 1
+                elif not self._decode(packet).isspace():
+                    # Lines of non-ASCII spaces are only skipped once decoded
+                    self.count_parse_error(error, packet)
+
+    def submit_metric_line(self, line):
+        """ Parse and submit one metric line. Returns the PARSE_ERROR_* class of a bad line. """
+        line = self._decode(line)
+        try:
+            parsed_packets = self.parse_metric_packet(line)
+        except Exception:
+            return PARSE_ERROR_LINE
+        for name, value, mtype, tags, sample_rate in parsed_packets:
+            if mtype not in self.metric_type_to_class:
+                return PARSE_ERROR_METRIC_TYPE
+        for name, value, mtype, tags, sample_rate in parsed_packets:
+            hostname, device_name, tags = self._extract_magic_tags(tags)
+            self.submit_metric(name, value, mtype, tags=tags, hostname=hostname,
+                               device_name=device_name, sample_rate=sample_rate)
+        return None
+
+    def count_parse_error(self, error, line):
+        """ Count a skipped line, and log an example of each class now and then """
+        self.parse_errors[error] = self.parse_errors.get(error, 0) + 1
+        now = time()
+        if now - self.parse_error_logged_at.get(error, 0) >= PARSE_ERROR_LOG_INTERVAL:
+            self.parse_error_logged_at[error] = now
+            log.warning('Skipped a statsd line with a bad %s (%d so far): %r' % (
+                error, self.parse_errors[error], self._decode(line)[:PARSE_ERROR_LOG_LENGTH]))
 
 
     def _extract_magic_tags(self, tags):
@@ -726,6 +1473,25 @@ class Aggregator(object):
         """ Flush aggregated metrics """
         raise NotImplementedError()
 
+    def internal_metrics(self):
+        """ (name, value, metric_type, tags) tuples describing the aggregator itself """
+        metrics = [('dogstatsd.parse_errors', count, MetricTypes.COUNTER, ('error:%s' % error,))
+                   for error, count in sorted(self.parse_errors.items())]
+        cache = self.context_cache
+        if cache is None:
+            return metrics
+        return metrics + [
+            ('dogstatsd.context_cache.hits', cache.hits, MetricTypes.COUNTER, ()),
+            ('dogstatsd.context_cache.misses', cache.misses, MetricTypes.COUNTER, ()),
+            ('dogstatsd.context_cache.evictions', cache.evictions, MetricTypes.COUNTER, ()),
+            ('dogstatsd.context_cache.entries', len(cache), MetricTypes.GAUGE, ()),
+            ('dogstatsd.context_cache.bytes', cache.size_bytes, MetricTypes.GAUGE, ()),
+        ]
+
+    def close(self):
+        """ Release resources held by the aggregator """
+        pass
+
     def flush_events(self):
         events = self.events
         self.events = []
@@ -755,11 +1521,20 @@ class MetricsBucketAggregator(Aggregator):
     """
     A metric aggregator class.
     """
+    # Hand flushed metric objects back to submit_packets, for the next bucket of their
+    #  context to reuse instead of creating a new one
+    recycle_metrics = True
 
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
                  formatter=None, recent_point_threshold=None,
                  histogram_aggregates=None, histogram_percentiles=None,
-                 utf8_decoding=False):
+                 utf8_decoding=False, context_cache_size=None,
+                 storage=STORAGE_OBJECTS, histogram_backend=HISTOGRAM_EXACT,
+                 histogram_relative_error=None, set_backend=SET_EXACT, set_precision=None,
+                 max_contexts=0, max_contexts_per_name=0):
+        if storage not in STORAGES:
+            raise ValueError('Unknown storage %s, expected one of %s' %
+                             (storage, ', '.join(STORAGES)))
         super(MetricsBucketAggregator, self).__init__(
             hostname,
             interval,
@@ -768,29 +1543,76 @@ class MetricsBucketAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            context_cache_size,
+            histogram_backend,
+            histogram_relative_error,
+            set_backend,
+            set_precision
         )
+        # What submit_packets fills, see retire_generation
+        self.generation = BucketGeneration()
+        self.retired_generation = None
+        # Set while submit_packets runs, and the number of calls that returned
+        self.submitting = False
+        self.submitted_batches = 0
+        # Set by submit_packets on its way out while a flush waits for it to let go of
+        #  a retired generation
+        self.swap_waiting = False
+        self.swap_done = threading.Event()
+        # bucket start -> context ID -> metric, for the buckets taken from retired
+        #  generations and not flushed yet. Only the flushing thread writes these.
         self.metric_by_bucket = {}
-        self.last_sample_time_by_context = {}
-        self.current_bucket = None
-        self.current_mbc = {}
+        # With columnar storage, counters and gauges are kept out of metric_by_bucket:
+        #  bucket start -> ColumnBucket, for the same buckets
+        self.columnar = storage == STORAGE_COLUMNAR
+        self.columns_by_bucket = {}
+        # Packets of self.count already reported, see take_count
+        self.counted = 0
+        # context ID -> an empty metric of a flushed bucket. Each flush publishes a new
+        #  dict and only submit_packets takes from it, see recycle_metrics.
+        self.recycled_metrics = {}
+        # Counters keep reporting zeros until they expire: context ID -> last sample time
+        self.last_sample_time_by_id = ExpiryWheel(self.interval)
+        self.contexts = ContextTable()
+        # Cardinality caps, 0 for none; see OVERFLOW_TAG
+        self.max_contexts = max_contexts
+        self.max_contexts_per_name = max_contexts_per_name
+        # metric name -> points whose new context was folded into an overflow context
+        self.rejected_by_name = {}
+        # context ID -> the MetricDescriptor shared by the metrics of that context.
+        #  Both threads create descriptors, under descriptor_lock.
+        self.descriptors = []
+        self.descriptor_lock = threading.Lock()
+        # context ID -> last sample time of the context as of its last flushed bucket.
+        #  Only written by the flushing thread.
+        self.last_seen_by_id = ExpiryWheel(self.interval)
+        # Context IDs to release, see release_expired_contexts
+        self.releasable_ids = deque()
         self.last_flush_cutoff_time = 0
         self.metric_type_to_class = {
             'g': BucketGauge,
             'c': Counter,
-            'h': Histogram,
-            'ms': Histogram,
-            's': Set,
+            'h': self.histogram_class,
+            'ms': self.histogram_class,
+            's': self.set_class,
         }
+        # metric class -> the type its overflow context is named after, see merge_buckets
+        self.metric_class_types = dict((metric_class, metric_type) for metric_type, metric_class
+                                       in self.metric_type_to_class.iteritems() if metric_type != 'ms')
 
     def calculate_bucket_start(self, timestamp):
         return timestamp - (timestamp % self.interval)
 
+    def current_flush_cutoff_time(self):
+        """ Start of the current bucket; every bucket before it is complete """
+        return self.calculate_bucket_start(time())
+
     def submit_metric(self, name, value, mtype, tags=None, hostname=None,
                       device_name=None, timestamp=None, sample_rate=1):
         # Avoid calling extra functions to dedupe tags if there are none
-        # Note: if you change the way that context is created, please also change create_empty_metrics,
-        #  which counts on this order
+        # Note: if you change the way that context is created, please also change create_empty_metrics
+        #  and parse_metric_line, which count on this order
 
         # Keep hostname with empty string to unset it
         hostname = hostname if hostname is not None else self.hostname
@@ -799,96 +1621,583 @@ class MetricsBucketAggregator(Aggregator):
             context = (name, tuple(), hostname, device_name)
         else:
             context = (name, tuple(sorted(set(tags))), hostname, device_name)
-
+        self.submit_context(context, value, mtype, timestamp, sample_rate)
+
+    def submit_metric_line(self, line):
+        """ Parse and submit one metric line, without going through submit_metric """
+        parsed = self._parse_metric_line(line, self._context_id)
+        if parsed.__class__ is not list:
+            return parsed
+        for context_id, value, mtype, sample_rate in parsed:
+            self.submit_context_id(context_id, value, mtype, sample_rate=sample_rate)
+        return None
+
+    def _context_id(self, name, raw_tags, metric_type):
+        cache = self.context_cache
+        if cache is None:
+            return self.intern_context(self._build_metric_context(name, raw_tags), metric_type)
+        key = (name, raw_tags)
+        entry = cache.get(key)
+        # A cached ID is stale once its context has been released
+        if entry is not None and self.contexts.contexts[entry[0]] is entry[1]:
+            return entry[0]
+        context = self._build_metric_context(name, raw_tags)
+        context_id = self.intern_context(context, metric_type)
+        # Overflowed points are not cached, so that each of them is counted
+        if self.contexts.contexts[context_id] == context:
+            cache.put(key, (context_id, self.contexts.contexts[context_id]))
+        return context_id
+
+    def intern_context(self, context, metric_type):
+        """ The ID of context, or of the overflow context it is folded into past a cap """
+        contexts = self.contexts
+        context_id = contexts.ids.get(context)
+        if context_id is not None:
+            return context_id
+        if self.max_contexts or self.max_contexts_per_name:
+            name = context[0]
+            over_global = self.max_contexts and len(contexts) >= self.max_contexts
+            if over_global or (self.max_contexts_per_name and
+                               contexts.count_by_name.get(name, 0) >= self.max_contexts_per_name):
+                self._count_rejected(name)
+                overflow = (name, (OVERFLOW_TAG,), self.hostname, None)
+                if over_global and overflow not in contexts.ids:
+                    # One per type, the points of every metric name end up together
+                    overflow = (GLOBAL_OVERFLOW_NAME, (OVERFLOW_TAG, 'type:%s' % metric_type),
+                                self.hostname, None)
+                context = overflow
+        return contexts.intern(context)
+
+    def _count_rejected(self, name):
+        rejected = self.rejected_by_name
+        if name not in rejected and len(rejected) >= MAX_REJECTED_NAMES:
+            name = REJECTED_OTHER_NAMES
+        rejected[name] = rejected.get(name, 0) + 1
+
+    def _metric_context(self, name, raw_tags, metric_type=None):
+        # The context cache holds interned IDs here, see _context_id
+        return self._build_metric_context(name, raw_tags)
+
+    def submit_context(self, context, value, mtype, timestamp=None, sample_rate=1):
+        """ Add a metric for an already canonical context, as built by submit_metric """
+        self.submit_context_id(self.intern_context(context, mtype), value, mtype, timestamp, sample_rate)
+
+    def submit_context_id(self, context_id, value, mtype, timestamp=None, sample_rate=1):
+        """ Add a metric for a context interned in self.contexts """
         cur_time = time()
+        generation = self.generation
         # Check to make sure that the timestamp that is passed in (if any) is not older than
         #  recent_point_threshold.  If so, discard the point.
         if timestamp is not None and cur_time - int(timestamp) > self.recent_point_threshold:
-            log.debug("Discarding %s - ts = %s , current ts = %s " % (name, timestamp, cur_time))
-            self.num_discarded_old_points += 1
+            log.debug("Discarding %s - ts = %s , current ts = %s " % (
+                self.contexts.contexts[context_id][0], timestamp, cur_time))
+            generation.num_discarded_old_points += 1
+            # Let the next flush release the context if nothing else uses it
+            generation.discarded_ids.append(context_id)
         else:
             timestamp = timestamp or cur_time
             # Keep track of the buckets using the timestamp at the start time of the bucket
             bucket_start_timestamp = self.calculate_bucket_start(timestamp)
-            if bucket_start_timestamp == self.current_bucket:
-                metric_by_context = self.current_mbc
-            else:
-                if bucket_start_timestamp not in self.metric_by_bucket:
-                    self.metric_by_bucket[bucket_start_timestamp] = {}
-                metric_by_context = self.metric_by_bucket[bucket_start_timestamp]
-                self.current_bucket = bucket_start_timestamp
-                self.current_mbc = metric_by_context
-
-            if context not in metric_by_context:
+            if bucket_start_timestamp != generation.current_bucket:
+                metric_by_bucket = generation.metric_by_bucket
+                if bucket_start_timestamp not in metric_by_bucket:
+                    metric_by_bucket[bucket_start_timestamp] = {}
+                generation.current_mbc = metric_by_bucket[bucket_start_timestamp]
+                if self.columnar:
+                    columns = generation.columns_by_bucket.get(bucket_start_timestamp)
+                    if columns is None:
+                        columns = generation.columns_by_bucket[bucket_start_timestamp] = ColumnBucket()
+                    generation.current_columns = columns
+                generation.current_bucket = bucket_start_timestamp
+
+            if self.columnar and context_id not in generation.current_mbc:
+                columns = generation.current_columns
+                if context_id < len(columns.counters):
+                    # The first type a context is sent with in a bucket wins, as with
+                    #  metric objects
+                    if columns.counter_times[context_id]:
+                        mtype = 'c'
+                    elif columns.gauge_times[context_id]:
+                        mtype = 'g'
+                if mtype == 'c' or mtype == 'g':
+                    if context_id >= len(columns.counters):
+                        columns.grow(context_id)
+                    if mtype == 'c':
+                        if not columns.counter_times[context_id]:
+                            columns.counter_ids.append(context_id)
+                        columns.counters[context_id] += value * int(1 / sample_rate)
+                        columns.counter_times[context_id] = cur_time
+                    else:
+                        if not columns.gauge_times[context_id]:
+                            columns.gauge_ids.append(context_id)
+                        columns.gauges[context_id] = value
+                        columns.gauge_times[context_id] = cur_time
+                    return
+
+            metric_by_id = generation.current_mbc
+            metric = metric_by_id.get(context_id)
+            if metric is None:
                 metric_class = self.metric_type_to_class[mtype]
-                metric_by_context[context] = metric_class(self.formatter, name, tags,
-                                                          hostname, device_name, self.metric_config.get(metric_class))
+                descriptor = self._descriptor(context_id)
+                metric = self.recycled_metrics.pop(context_id, None)
+                # Unless the ID was released and handed to another context since, or
+                #  the context is sent with another type
+                if metric is None or metric.__class__ is not metric_class or \
+                        metric.descriptor is not descriptor:
+                    metric = metric_class.from_descriptor(descriptor, self.metric_config.get(metric_class))
+                metric_by_id[context_id] = metric
+
+            metric.sample(value, sample_rate, timestamp)
+
+    def _descriptor(self, context_id):
+        """ The descriptor of an interned context, created on its first metric """
+        descriptors = self.descriptors
+        if context_id < len(descriptors):
+            descriptor = descriptors[context_id]
+            if descriptor is not None:
+                return descriptor
+        # The submitting thread creates them for metric objects, the flushing one for
+        #  columns and zero-filled counters
+        with self.descriptor_lock:
+            if context_id >= len(descriptors):
+                descriptors.extend([None] * (context_id + 1 - len(descriptors)))
+            descriptor = descriptors[context_id]
+            if descriptor is None:
+                # This counts on the ordering of the context created in submit_metric not changing
+                context = self.contexts.contexts[context_id]
+                descriptor = descriptors[context_id] = MetricDescriptor(
+                    self.formatter, context[0], context[1] or None, context[2], context[3])
+            return descriptor
 
-            metric_by_context[context].sample(value, sample_rate, timestamp)
+    def pop_buckets(self, flush_cutoff_time):
+        """
+        Detach and return the buckets that are complete at flush_cutoff_time, together
+        with the number of packets received since the last call, so that another
+        aggregator can merge them in. The buckets are keyed by context, context IDs
+        only mean something to the aggregator that assigned them.
+        """
+        self.absorb_generation(self.retire_generation())
+        contexts = self.contexts.contexts
+        last_seen_by_id = self.last_seen_by_id
+        buckets = {}
+        for bucket_start_timestamp in self.metric_by_bucket.keys():
+            if bucket_start_timestamp < flush_cutoff_time:
+                metric_by_context = buckets[bucket_start_timestamp] = {}
+                for context_id, metric in self.metric_by_bucket[bucket_start_timestamp].iteritems():
+                    metric_by_context[contexts[context_id]] = metric
+                    last_seen_by_id[context_id] = metric.last_sample_time
+                columns = self.columns_by_bucket.get(bucket_start_timestamp)
+                if columns is not None:
+                    for context_id, metric in self.column_metrics(columns):
+                        last_seen_by_id[context_id] = metric.last_sample_time
+                        context = contexts[context_id]
+                        if context in metric_by_context:
+                            log.debug("%s was sent with several types, keeping the %s" % (
+                                context, metric_by_context[context].__class__.__name__))
+                        else:
+                            metric_by_context[context] = metric
+        # Only once last_seen_by_id covers them, see apply_context_releases
+        for bucket_start_timestamp in buckets:
+            del self.metric_by_bucket[bucket_start_timestamp]
+            self.columns_by_bucket.pop(bucket_start_timestamp, None)
+        self.release_expired_contexts(time() - self.expiry_seconds)
+        return buckets, self.take_count()
+
+    def retire_generation(self):
+        """
+        Swap in a new generation for submit_packets and return the one it was filling.
+        No lock is taken: submit_packets announces itself before it looks up the
+        generation, so once a call in progress has returned, nothing writes to the
+        retired one any more. Only the flushing thread waits, for one batch at most,
+        until submit_packets acknowledges the swap on its way out.
+        """
+        retired = self.retired_generation = self.generation
+        self.generation = BucketGeneration()
+        batches = self.submitted_batches
+        self.swap_waiting = True
+        try:
+            while True:
+                # submit_packets clears submitting before it sets swap_done, a wakeup
+                #  is never lost between the check and the wait
+                self.swap_done.clear()
+                if not self.submitting or self.submitted_batches != batches:
+                    break
+                self.swap_done.wait()
+        finally:
+            self.swap_waiting = False
+        return retired
+
+    def absorb_generation(self, generation):
+        """ Move the buckets of a retired generation to those waiting for a flush """
+        contexts = self.contexts.contexts
+        for bucket_start_timestamp, retired in generation.metric_by_bucket.iteritems():
+            existing = self.metric_by_bucket.get(bucket_start_timestamp)
+            if existing is None:
+                self.metric_by_bucket[bucket_start_timestamp] = retired
+                continue
+            # A bucket still incomplete at the previous flush
+            columns = self.columns_by_bucket.get(bucket_start_timestamp, ())
+            for context_id, metric in retired.iteritems():
+                if context_id in existing:
+                    existing[context_id].merge(metric)
+                elif context_id in columns:
+                    log.debug("%s was sent with several types, keeping the first" % (
+                        contexts[context_id],))
+                else:
+                    existing[context_id] = metric
+        for bucket_start_timestamp, retired in generation.columns_by_bucket.iteritems():
+            existing = self.columns_by_bucket.get(bucket_start_timestamp)
+            metric_by_id = self.metric_by_bucket[bucket_start_timestamp]
+            if existing is None:
+                if not any(context_id in metric_by_id
+                           for context_id in retired.counter_ids + retired.gauge_ids):
+                    self.columns_by_bucket[bucket_start_timestamp] = retired
+                    continue
+                existing = self.columns_by_bucket[bucket_start_timestamp] = ColumnBucket()
+            existing.merge(retired, metric_by_id)
+        self.num_discarded_old_points += generation.num_discarded_old_points
+        for context_id in generation.discarded_ids:
+            self.last_seen_by_id.setdefault(context_id, 0)
+        self.retired_generation = None
+
+    def take_count(self):
+        """
+        The number of packets counted since the last call. self.count is never reset,
+        so that the thread counting packets is the only one writing it.
+        """
+        count = self.count
+        taken = count - self.counted
+        self.counted = count
+        return taken
+
+    def column_metrics(self, columns):
+        """
+        Yield (context ID, metric) for the values of a ColumnBucket, as metric objects.
+        pop_buckets hands buckets over this way, so sharded listeners and parse workers
+        pay for one object per series and bucket again, as with object storage.
+        """
+        for context_id in columns.counter_ids:
+            metric = Counter.from_descriptor(self._descriptor(context_id))
+            metric.value = columns.counters[context_id]
+            metric.last_sample_time = columns.counter_times[context_id]
+            yield context_id, metric
+        for context_id in columns.gauge_ids:
+            metric = BucketGauge.from_descriptor(self._descriptor(context_id))
+            metric.value = columns.gauges[context_id]
+            metric.last_sample_time = metric.timestamp = columns.gauge_times[context_id]
+            yield context_id, metric
+
+    def merge_buckets(self, buckets, count=0):
+        """
+        Merge buckets detached from another aggregator with pop_buckets. Each shard or
+        worker caps its own contexts, the caps are applied again here so that they
+        hold overall; a context folded here is counted as rejected once per merge.
+        """
+        intern = self.intern_context
+        contexts = self.contexts.contexts
+        metric_types = self.metric_class_types
+        for bucket_start_timestamp, other_by_context in buckets.iteritems():
+            metric_by_id = self.metric_by_bucket.setdefault(bucket_start_timestamp, {})
+            for context, metric in other_by_context.iteritems():
+                context_id = intern(context, metric_types.get(metric.__class__))
+                existing = metric_by_id.get(context_id)
+                if existing is None:
+                    if contexts[context_id] != context:
+                        # Reported as the overflow context it was folded into
+                        metric.descriptor = self._descriptor(context_id)
+                    metric_by_id[context_id] = metric
+                elif existing.__class__ is metric.__class__:
+                    existing.merge(metric)
+                else:
+                    # Folded into an overflow context that holds another type
+                    log.debug("%s was sent with several types, keeping the %s" % (
+                        contexts[context_id], existing.__class__.__name__))
+        self.count += count
+
+    def release_expired_contexts(self, expiry_timestamp):
+        """
+        Queue the IDs of contexts last seen before expiry_timestamp for release. IDs
+        are handed out and used by the thread submitting packets, which flushes run
+        alongside, so that thread releases them on its next submit_packets.
+        """
+        releasable = self.last_seen_by_id.pop_expired(expiry_timestamp)
+        for context_id in releasable:
+            self.last_sample_time_by_id.pop(context_id, None)
+        self.releasable_ids.extend(releasable)
+
+    def apply_context_releases(self):
+        """ Release the context IDs queued by release_expired_contexts that are still unused """
+        releasable = self.releasable_ids
+        # The retired generation first: once absorbed, its buckets are in metric_by_bucket
+        pending = []
+        for generation in [self.retired_generation, self.generation]:
+            if generation is not None:
+                pending += generation.metric_by_bucket.values() + generation.columns_by_bucket.values()
+        pending += self.metric_by_bucket.values() + self.columns_by_bucket.values()
+        last_seen_by_id = self.last_seen_by_id
+        while releasable:
+            context_id = releasable.popleft()
+            # Sampled again since it was queued: still pending, or flushed since
+            if context_id not in last_seen_by_id and \
+                    not any(context_id in metric_by_id for metric_by_id in pending):
+                self.contexts.release(context_id)
+                with self.descriptor_lock:
+                    if context_id < len(self.descriptors):
+                        self.descriptors[context_id] = None
 
-    def create_empty_metrics(self, sample_time_by_context, expiry_timestamp, flush_timestamp, metrics):
+    def submit_packets(self, packets):
+        # Announced before the generation is looked up, see retire_generation
+        self.submitting = True
+        try:
+            if self.releasable_ids:
+                self.apply_context_releases()
+            super(MetricsBucketAggregator, self).submit_packets(packets)
+        finally:
+            self.submitted_batches += 1
+            self.submitting = False
+            if self.swap_waiting:
+                self.swap_done.set()
+
+    def expire_counters(self, expiry_timestamp):
+        """ Stop zero-filling the counters not sampled since expiry_timestamp """
+        contexts = self.contexts.contexts
+        for context_id in self.last_sample_time_by_id.pop_expired(expiry_timestamp):
+            log.debug("%s hasn't been submitted in %ss. Expiring." % (
+                contexts[context_id], self.expiry_seconds))
+
+    def create_empty_metrics(self, flush_timestamp, metric_by_id=None, columns=None):
         # Even if no data is submitted, Counters keep reporting "0" for expiry_seconds.  The other Metrics
-        #  (Set, Gauge, Histogram) do not report if no data is submitted
-        for context, last_sample_time in sample_time_by_context.items():
-            if last_sample_time < expiry_timestamp:
-                log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                self.last_sample_time_by_context.pop(context, None)
-            else:
-                # The expiration currently only applies to Counters
-                # This counts on the ordering of the context created in submit_metric not changing
-                metric = Counter(self.formatter, context[0], context[1], context[2], context[3])
-                metrics += metric.flush(flush_timestamp, self.interval)
+        #  (Set, Gauge, Histogram) do not report if no data is submitted.
+        # The points are formatted straight from the descriptors, skipping the counters
+        #  with a value in the bucket flushed, in metric_by_id or columns.
+        interval = self.interval
+        value = 0 / interval
+        descriptor_of = self._descriptor
+        sampled_ids = metric_by_id if metric_by_id is not None else ()
+        counter_times = columns.counter_times if columns is not None else ()
+        num_columns = len(counter_times)
+        for context_id in self.last_sample_time_by_id:
+            if context_id in sampled_ids or (context_id < num_columns and counter_times[context_id]):
+                continue
+            descriptor = descriptor_of(context_id)
+            yield descriptor.formatter(
+                metric=descriptor.name,
+                value=value,
+                timestamp=flush_timestamp,
+                tags=descriptor.tags,
+                hostname=descriptor.hostname,
+                device_name=descriptor.device_name,
+                metric_type=MetricTypes.RATE,
+                interval=interval,
+            )
+
+    def flush_columns(self, columns, timestamp, expiry_timestamp):
+        """
+        Flush the counters and gauges of a ColumnBucket, as flush does metric objects.
+        Each point is still formatted on its own, this is no faster than objects.
+        """
+        interval = self.interval
+        descriptor_of = self._descriptor
+        last_seen_by_id = self.last_seen_by_id
+        last_sample_time_by_id = self.last_sample_time_by_id
+        for ids, values, times, metric_type in [
+                (columns.counter_ids, columns.counters, columns.counter_times, MetricTypes.RATE),
+                (columns.gauge_ids, columns.gauges, columns.gauge_times, MetricTypes.GAUGE)]:
+            is_counter = metric_type == MetricTypes.RATE
+            for context_id in ids:
+                last_sample_time = last_seen_by_id[context_id] = times[context_id]
+                if last_sample_time < expiry_timestamp:
+                    # This should never happen
+                    last_sample_time_by_id.pop(context_id, None)
+                    continue
+                descriptor = descriptor_of(context_id)
+                value = values[context_id]
+                if is_counter:
+                    value /= interval
+                    last_sample_time_by_id[context_id] = last_sample_time
+                yield descriptor.formatter(
+                    metric=descriptor.name,
+                    value=value,
+                    timestamp=timestamp,
+                    tags=descriptor.tags,
+                    hostname=descriptor.hostname,
+                    device_name=descriptor.device_name,
+                    metric_type=metric_type,
+                    interval=interval,
+                )
+
+    def flush_bucket(self, bucket_start_timestamp, expiry_timestamp, recycled, batch_size):
+        """ Yield the points of a complete bucket, and drop the bucket """
+        contexts = self.contexts.contexts
+        last_seen_by_id = self.last_seen_by_id
+        metric_by_id = self.metric_by_bucket[bucket_start_timestamp]
+        columns = self.columns_by_bucket.get(bucket_start_timestamp)
+        try:
+            histograms = []
+            expired = []
+            # Only this thread writes the bucket once it is complete, an iterator is safe
+            #  across the yields as long as expired metrics are removed after the loop
+            for context_id, metric in metric_by_id.iteritems():
+                last_seen_by_id[context_id] = metric.last_sample_time
+                if metric.last_sample_time < expiry_timestamp:
+                    # This should never happen
+                    log.warning("%s hasn't been submitted in %ss. Expiring." % (
+                        contexts[context_id], self.expiry_seconds))
+                    self.last_sample_time_by_id.pop(context_id, None)
+                    expired.append(context_id)
+                elif metric.__class__ is Histogram:
+                    histograms.append(metric)
+                else:
+                    for point in metric.flush(bucket_start_timestamp, self.interval):
+                        yield point
+                    if isinstance(metric, Counter):
+                        self.last_sample_time_by_id[context_id] = metric.last_sample_time
+            for context_id in expired:
+                del metric_by_id[context_id]
+            for i in xrange(0, len(histograms), batch_size):
+                for point in Histogram.flush_all(histograms[i:i + batch_size], bucket_start_timestamp,
+                                                 self.interval):
+                    yield point
+            if self.recycle_metrics:
+                recycled.update(metric_by_id)
+            if columns is not None:
+                for point in self.flush_columns(columns, bucket_start_timestamp, expiry_timestamp):
+                    yield point
+            # We need to account for Metrics that have not expired and were not flushed for this bucket
+            for point in self.create_empty_metrics(bucket_start_timestamp, metric_by_id, columns):
+                yield point
+        finally:
+            # Whatever a flush left unfinished is dropped, rather than reported twice.
+            #  Until then the bucket keeps its contexts from being released, see
+            #  apply_context_releases, whatever the sender does between two batches.
+            del self.metric_by_bucket[bucket_start_timestamp]
+            self.columns_by_bucket.pop(bucket_start_timestamp, None)
 
     def flush(self):
+        metrics = []
+        for batch in self.flush_batches():
+            metrics += batch
+        return metrics
+
+    def flush_batches(self, batch_size=FLUSH_BATCH_SIZE):
+        """
+        Flush the complete buckets, yielding their points in lists of at most batch_size
+        as they are formatted, so that a flush holds one batch at a time whatever the
+        number of contexts.
+        """
         cur_time = time()
         flush_cutoff_time = self.calculate_bucket_start(cur_time)
         expiry_timestamp = cur_time - self.expiry_seconds
 
-        metrics = []
+        self.absorb_generation(self.retire_generation())
+        self.expire_counters(expiry_timestamp)
+        recycled = {}
 
-        if self.metric_by_bucket:
-            # We want to process these in order so that we can check for and expired metrics and
-            #  re-create non-expired metrics.  We also mutate self.metric_by_bucket.
-            for bucket_start_timestamp in sorted(self.metric_by_bucket.keys()):
-                metric_by_context = self.metric_by_bucket[bucket_start_timestamp]
-                if bucket_start_timestamp < flush_cutoff_time:
-                    not_sampled_in_this_bucket = self.last_sample_time_by_context.copy()
-                    # We mutate this dictionary while iterating so don't use an iterator.
-                    for context, metric in metric_by_context.items():
-                        if metric.last_sample_time < expiry_timestamp:
-                            # This should never happen
-                            log.warning("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                            not_sampled_in_this_bucket.pop(context, None)
-                            self.last_sample_time_by_context.pop(context, None)
-                        else:
-                            metrics += metric.flush(bucket_start_timestamp, self.interval)
-                            if isinstance(metric, Counter):
-                                self.last_sample_time_by_context[context] = metric.last_sample_time
-                                not_sampled_in_this_bucket.pop(context, None)
-                    # We need to account for Metrics that have not expired and were not flushed for this bucket
-                    self.create_empty_metrics(not_sampled_in_this_bucket, expiry_timestamp, bucket_start_timestamp, metrics)
-
-                    del self.metric_by_bucket[bucket_start_timestamp]
-        else:
-            # Even if there are no metrics in this flush, there may be some non-expired counters
-            #  We should only create these non-expired metrics if we've passed an interval since the last flush
-            if flush_cutoff_time >= self.last_flush_cutoff_time + self.interval:
-                self.create_empty_metrics(self.last_sample_time_by_context.copy(), expiry_timestamp,
-                                          flush_cutoff_time-self.interval, metrics)
+        batch = []
+        try:
+            if self.metric_by_bucket:
+                # We want to process these in order so that we can check for and expired metrics and
+                #  re-create non-expired metrics.  We also mutate self.metric_by_bucket.
+                for bucket_start_timestamp in sorted(self.metric_by_bucket.keys()):
+                    if bucket_start_timestamp >= flush_cutoff_time:
+                        continue
+                    for point in self.flush_bucket(bucket_start_timestamp, expiry_timestamp,
+                                                   recycled, batch_size):
+                        batch.append(point)
+                        if len(batch) >= batch_size:
+                            yield batch
+                            batch = []
+            else:
+                # Even if there are no metrics in this flush, there may be some non-expired counters
+                #  We should only create these non-expired metrics if we've passed an interval since the last flush
+                if flush_cutoff_time >= self.last_flush_cutoff_time + self.interval:
+                    for point in self.create_empty_metrics(flush_cutoff_time-self.interval):
+                        batch.append(point)
+                        if len(batch) >= batch_size:
+                            yield batch
+                            batch = []
+            if batch:
+                yield batch
+        finally:
+            if recycled:
+                # The metrics flushed before are dropped, whatever was not reused of them
+                self.recycled_metrics = recycled
 
-        # Log a warning regarding metrics with old timestamps being submitted
-        if self.num_discarded_old_points > 0:
-            log.warn('%s points were discarded as a result of having an old timestamp' % self.num_discarded_old_points)
-            self.num_discarded_old_points = 0
+            self.release_expired_contexts(expiry_timestamp)
 
-        # Save some stats.
-        # log.debug("received %s payloads since last flush" % self.count)
-        self.total_count += self.count
-        self.count = 0
-        self.current_bucket = None
-        self.current_mbc = {}
-        self.last_flush_cutoff_time = flush_cutoff_time
-        return metrics
+            # Log a warning regarding metrics with old timestamps being submitted
+            if self.num_discarded_old_points > 0:
+                log.warn('%s points were discarded as a result of having an old timestamp' %
+                         self.num_discarded_old_points)
+                self.num_discarded_old_points = 0
+
+            # Save some stats.
+            # log.debug("received %s payloads since last flush" % self.count)
+            self.total_count += self.take_count()
+            self.last_flush_cutoff_time = flush_cutoff_time
+
+    def internal_metrics(self):
+        return super(MetricsBucketAggregator, self).internal_metrics() + [
+            ('dogstatsd.contexts', len(self.contexts), MetricTypes.GAUGE, ()),
+        ] + [('dogstatsd.contexts.rejected', count, MetricTypes.COUNTER, ('metric:%s' % name,))
+             for name, count in sorted(self.rejected_by_name.items())]
+
+
+class ShardedMetricsAggregator(MetricsBucketAggregator):
+    """
+    A bucket aggregator that owns no listener of its own. Each shard is fed by its
+    own receive thread, and the completed buckets of every shard are merged into this
+    aggregator at flush time, before the usual bucket flush runs.
+    """
+    # The metrics come from the shards, nothing is sampled here that could reuse them
+    recycle_metrics = False
+
+    def __init__(self, shards, hostname, interval=1.0, expiry_seconds=300,
+                 formatter=None, recent_point_threshold=None,
+                 histogram_aggregates=None, histogram_percentiles=None,
+                 utf8_decoding=False, context_cache_size=None,
+                 storage=STORAGE_OBJECTS, histogram_backend=HISTOGRAM_EXACT,
+                 histogram_relative_error=None, set_backend=SET_EXACT, set_precision=None,
+                 max_contexts=0, max_contexts_per_name=0):
+        super(ShardedMetricsAggregator, self).__init__(
+            hostname,
+            interval,
+            expiry_seconds,
+            formatter,
+            recent_point_threshold,
+            histogram_aggregates,
+            histogram_percentiles,
+            utf8_decoding,
+            context_cache_size,
+            storage,
+            histogram_backend,
+            histogram_relative_error,
+            set_backend,
+            set_precision,
+            max_contexts,
+            max_contexts_per_name
+        )
+        self.shards = shards
+
+    def flush_batches(self, batch_size=FLUSH_BATCH_SIZE):
+        flush_cutoff_time = self.current_flush_cutoff_time()
+        for shard in self.shards:
+            buckets, count = shard.pop_buckets(flush_cutoff_time)
+            self.merge_buckets(buckets, count)
+            self.num_discarded_old_points += shard.num_discarded_old_points
+            shard.num_discarded_old_points = 0
+        try:
+            for batch in super(ShardedMetricsAggregator, self).flush_batches(batch_size):
+                yield batch
+        finally:
+            # Nothing is submitted to this aggregator directly, its IDs are only used here
+            if self.releasable_ids:
+                self.apply_context_releases()
+
+    def internal_metrics(self):
+        return sum_internal_metrics(
+            [super(ShardedMetricsAggregator, self).internal_metrics()] +
+            [shard.internal_metrics() for shard in self.shards])
 
 
 class MetricsAggregator(Aggregator):
@@ -899,7 +2208,9 @@ class MetricsAggregator(Aggregator):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
                  formatter=None, recent_point_threshold=None,
                  histogram_aggregates=None, histogram_percentiles=None,
-                 utf8_decoding=False):
+                 utf8_decoding=False, context_cache_size=None,
+                 histogram_backend=HISTOGRAM_EXACT, histogram_relative_error=None,
+                 set_backend=SET_EXACT, set_precision=None):
         super(MetricsAggregator, self).__init__(
             hostname,
             interval,
@@ -908,7 +2219,12 @@ class MetricsAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            context_cache_size,
+            histogram_backend,
+            histogram_relative_error,
+            set_backend,
+            set_precision
         )
         self.metrics = {}
         self.metric_type_to_class = {
@@ -916,10 +2232,10 @@ class MetricsAggregator(Aggregator):
             'ct': Count,
             'ct-c': MonotonicCount,
             'c': Counter,
-            'h': Histogram,
-            'ms': Histogram,
-            'd': Histogram,
-            's': Set,
+            'h': self.histogram_class,
+            'ms': self.histogram_class,
+            'd': self.histogram_class,
+            's': self.set_class,
             '_dd-r': Rate,
         }
 
@@ -978,12 +2294,16 @@ class MetricsAggregator(Aggregator):
         # Flush points and remove expired metrics. We mutate this dictionary
         # while iterating so don't use an iterator.
         metrics = []
+        histograms = []
         for context, metric in self.metrics.items():
             if metric.last_sample_time < expiry_timestamp:
                 log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
                 del self.metrics[context]
+            elif metric.__class__ is Histogram:
+                histograms.append(metric)
             else:
                 metrics += metric.flush(timestamp, self.interval)
+        metrics += Histogram.flush_all(histograms, timestamp, self.interval)
 
         # Log a warning regarding metrics with old timestamps being submitted
         if self.num_discarded_old_points > 0:
@@ -1027,3 +2347,16 @@ def api_formatter(metric, value, timestamp, tags, hostname=None, device_name=Non
         'type': metric_type or MetricTypes.GAUGE,
         'interval':interval,
     }
+
+
+# A flushed point as one small tuple, where api_formatter builds a dict holding a list
+#  and a tuple. Pass Point as an aggregator's formatter to flush Points; its fields are
+#  api_formatter's arguments, in the same order.
+Point = namedtuple('Point', ['metric', 'value', 'timestamp', 'tags', 'hostname',
+                             'device_name', 'metric_type', 'interval'])
+Point.__new__.__defaults__ = (None, None, None, None)
+
+
+def point_as_dict(point):
+    """ The dict api_formatter would have built for a Point """
+    return api_formatter(*point)
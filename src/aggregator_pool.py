@@ -0,0 +1,212 @@
+"""
+Parse and pre-aggregate statsd packets in worker processes.
+
+The receive thread only hands raw datagrams to ProcessPoolAggregator.submit_packets,
+which ships them to a pool of worker processes. Each worker runs its own
+MetricsBucketAggregator, so parsing and sampling never hold the GIL of the process
+running collectd's Python plugins. At flush time the workers return their completed
+buckets, which are merged into the pool aggregator and flushed as usual.
+"""
+# stdlib
+import itertools
+import logging
+import multiprocessing
+import Queue
+import signal
+from time import time
+
+# project
+from aggregator import FLUSH_BATCH_SIZE, HISTOGRAM_EXACT, SET_EXACT, STORAGE_OBJECTS, \
+    MetricsBucketAggregator, MetricTypes, sum_internal_metrics
+
+log = logging.getLogger(__name__)
+
+# Seconds to wait for the workers' partial aggregates on flush, the longest a flush
+#  blocks the thread reading metrics. Partials that arrive later are merged on the
+#  next flush.
+WORKER_FLUSH_TIMEOUT = 2.0
+# Maximum number of batches queued for one worker before new ones are dropped
+WORKER_QUEUE_SIZE = 10000
+
+_FLUSH = 'flush'
+
+
+def _worker_main(worker_id, inbox, outbox, hostname, interval, aggregator_kwargs):
+    # The parent handles signals and tells us when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    aggregator = MetricsBucketAggregator(hostname, interval, **aggregator_kwargs)
+    while True:
+        item = inbox.get()
+        if item is None:
+            break
+        if isinstance(item, tuple):
+            _, sequence, flush_cutoff_time = item
+            buckets, count = aggregator.pop_buckets(flush_cutoff_time)
+            discarded = aggregator.num_discarded_old_points
+            aggregator.num_discarded_old_points = 0
+            outbox.put((worker_id, sequence, buckets, count, discarded, aggregator.internal_metrics()))
+            continue
+        try:
+            aggregator.submit_packets(item)
+        except Exception:
+            log.exception('Error parsing packets in worker %d' % worker_id)
+
+
+class ProcessPoolAggregator(MetricsBucketAggregator):
+    """
+    A bucket aggregator whose packets are parsed and pre-aggregated by worker processes.
+    """
+    # The metrics are unpickled from the workers, nothing is sampled here that could reuse them
+    recycle_metrics = False
+
+    def __init__(self, workers, hostname, interval=1.0, expiry_seconds=300,
+                 formatter=None, recent_point_threshold=None,
+                 histogram_aggregates=None, histogram_percentiles=None,
+                 utf8_decoding=False, context_cache_size=None,
+                 storage=STORAGE_OBJECTS, histogram_backend=HISTOGRAM_EXACT,
+                 histogram_relative_error=None, set_backend=SET_EXACT, set_precision=None,
+                 max_contexts=0, max_contexts_per_name=0):
+        super(ProcessPoolAggregator, self).__init__(
+            hostname,
+            interval,
+            expiry_seconds,
+            formatter,
+            recent_point_threshold,
+            histogram_aggregates,
+            histogram_percentiles,
+            utf8_decoding,
+            context_cache_size,
+            storage,
+            histogram_backend,
+            histogram_relative_error,
+            set_backend,
+            set_precision,
+            max_contexts,
+            max_contexts_per_name
+        )
+        # Workers rebuild their aggregators from these; formatter must be picklable
+        self.worker_args = (hostname, interval, dict(
+            expiry_seconds=expiry_seconds,
+            formatter=formatter,
+            recent_point_threshold=recent_point_threshold,
+            histogram_aggregates=histogram_aggregates,
+            histogram_percentiles=histogram_percentiles,
+            utf8_decoding=utf8_decoding,
+            context_cache_size=context_cache_size,
+            storage=storage,
+            histogram_backend=histogram_backend,
+            histogram_relative_error=histogram_relative_error,
+            set_backend=set_backend,
+            set_precision=set_precision,
+            max_contexts=max_contexts,
+            max_contexts_per_name=max_contexts_per_name,
+        ))
+        self.num_workers = max(1, int(workers))
+        self.outbox = multiprocessing.Queue()
+        self.inboxes = []
+        self.processes = []
+        # Shared by every listener thread. next() on a count is atomic under the GIL,
+        #  so batches are spread over the workers without a lock.
+        self.batch_numbers = itertools.count()
+        # Numbers the flush requests, so that a late answer is not taken for the current one
+        self.flush_sequence = 0
+        # Batches dropped because a worker's queue was full, never reset, and how many
+        #  of them were logged already
+        self.num_dropped_batches = 0
+        self.logged_dropped_batches = 0
+        # worker_id -> the internal metrics of its aggregator as of its last flush
+        self.worker_metrics = {}
+
+    def start(self):
+        """ Fork the workers. Call this before any listening socket is opened. """
+        for worker_id in range(self.num_workers):
+            self.inboxes.append(multiprocessing.Queue(WORKER_QUEUE_SIZE))
+            self.processes.append(None)
+            self._spawn(worker_id)
+
+    def _spawn(self, worker_id):
+        process = multiprocessing.Process(
+            target=_worker_main,
+            args=(worker_id, self.inboxes[worker_id], self.outbox) + self.worker_args,
+            name='dogstatsd-worker-%d' % worker_id)
+        process.daemon = True
+        process.start()
+        self.processes[worker_id] = process
+
+    def submit_packets(self, packets):
+        """ Ship raw packets to the next worker, without parsing them here. """
+        worker_id = next(self.batch_numbers) % self.num_workers
+        try:
+            self.inboxes[worker_id].put_nowait(packets)
+        except Queue.Full:
+            self.num_dropped_batches += 1
+
+    def flush_batches(self, batch_size=FLUSH_BATCH_SIZE):
+        """
+        Collect the workers' partial aggregates and flush them. This waits up to
+        WORKER_FLUSH_TIMEOUT for the workers to answer, before the first batch.
+        """
+        flush_cutoff_time = self.current_flush_cutoff_time()
+        self.flush_sequence += 1
+        sequence = self.flush_sequence
+        expected = 0
+        for worker_id, process in enumerate(self.processes):
+            if not process.is_alive():
+                log.error('dogstatsd worker %d exited with %s, restarting' % (worker_id, process.exitcode))
+                self._spawn(worker_id)
+            # Never block the read thread on a backlogged worker, it is asked again next time
+            try:
+                self.inboxes[worker_id].put_nowait((_FLUSH, sequence, flush_cutoff_time))
+                expected += 1
+            except Queue.Full:
+                log.warning('dogstatsd worker %d is backlogged, skipping its flush' % worker_id)
+
+        deadline = time() + WORKER_FLUSH_TIMEOUT
+        while expected > 0:
+            try:
+                worker_id, answered, buckets, count, discarded, metrics = self.outbox.get(
+                    timeout=max(0, deadline - time()))
+            except Queue.Empty:
+                log.warning('%d dogstatsd workers did not answer the flush in time' % expected)
+                break
+            # A late answer to an earlier flush still carries points, merge them but keep
+            #  waiting for the answer to this one
+            self.merge_buckets(buckets, count)
+            self.num_discarded_old_points += discarded
+            if answered == sequence:
+                self.worker_metrics[worker_id] = metrics
+                expected -= 1
+
+        dropped = self.num_dropped_batches
+        if dropped > self.logged_dropped_batches:
+            log.warn('%s packet batches were dropped because the workers were backlogged' %
+                     (dropped - self.logged_dropped_batches))
+            self.logged_dropped_batches = dropped
+
+        try:
+            for batch in super(ProcessPoolAggregator, self).flush_batches(batch_size):
+                yield batch
+        finally:
+            # Packets are parsed by the workers, the IDs of this aggregator are only used here
+            if self.releasable_ids:
+                self.apply_context_releases()
+
+    def internal_metrics(self):
+        # Lines are parsed by the workers, this aggregator's own cache stays empty
+        return sum_internal_metrics(self.worker_metrics.values()) + [
+            ('dogstatsd.workers.dropped_batches', self.num_dropped_batches, MetricTypes.COUNTER, ()),
+        ]
+
+    def close(self):
+        for inbox in self.inboxes:
+            try:
+                inbox.put_nowait(None)
+            except Queue.Full:
+                pass
+        for process in self.processes:
+            process.join(WORKER_FLUSH_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+        self.inboxes = []
+        self.processes = []
@@ -1,13 +1,17 @@
 import threading
 import time
 
+import aggregator
 import dogstatsd
+import ringbuffer
 
 PLUGIN_NAME = "dogstatsd"
 DEFAULT_SOCKET = None
 DEFAULT_IP = "0.0.0.0"
 MAX_RECV_SIZE = 65535
 INGEST_URL = "https://ingest.signalfx.com"
+# Seconds shutdown waits for the server thread, collectd must not hang on it
+SHUTDOWN_TIMEOUT = 5
 
 
 class Logger(object):
@@ -41,6 +45,7 @@ class Logger(object):
 DOG_STATSD_TYPE_TO_COLLECTD_TYPE = {
     "gauge": "gauge",
     "rate": "absolute",
+    "counter": "derive",
 }
 
 
@@ -49,9 +54,30 @@ class DogstatsDConfig(object):
     def __init__(self, log, timeout=dogstatsd.UDP_SOCKET_TIMEOUT):
         self.udp_timeout = timeout
         self.listen_port = DEFAULT_SOCKET
+        self.socket_path = None
+        self.tcp_port = None
+        self.stream_socket_path = None
+        self.max_stream_connections = dogstatsd.STREAM_MAX_CONNECTIONS
         self.verbose_logging = False
         self.listen_ip = DEFAULT_IP
         self.max_recv_size = MAX_RECV_SIZE
+        self.recv_batch_size = dogstatsd.RECV_BATCH_SIZE
+        self.listeners = 1
+        self.parse_workers = 0
+        self.recv_buffer = None
+        self.internal_metrics = False
+        self.queue_size = 0
+        self.queue_overflow = ringbuffer.DROP_NEWEST
+        self.forward_host = None
+        self.forward_port = None
+        self.context_cache_size = None
+        self.storage = aggregator.STORAGE_OBJECTS
+        self.histogram_backend = aggregator.HISTOGRAM_EXACT
+        self.histogram_relative_error = None
+        self.set_backend = aggregator.SET_EXACT
+        self.set_precision = None
+        self.max_contexts = 0
+        self.max_contexts_per_metric = 0
         self.aggregator_interval = dogstatsd.DOGSTATSD_AGGREGATOR_BUCKET_SIZE
         self.read_to_collectd = False
         self.ingest_endpoint = INGEST_URL
@@ -64,12 +90,91 @@ class DogstatsDConfig(object):
         for node in conf.children:
             if node.key == "DogStatsDPort":
                 self.listen_port = int(node.values[0])
+            elif node.key == "DogStatsDSocket":
+                self.socket_path = node.values[0]
+            elif node.key == "DogStatsDTCPPort":
+                self.tcp_port = int(node.values[0])
+            elif node.key == "DogStatsDStreamSocket":
+                self.stream_socket_path = node.values[0]
+            elif node.key == "MaxStreamConnections":
+                self.max_stream_connections = int(node.values[0])
             elif node.key == "IP":
                 self.listen_ip = node.values[0]
             elif node.key == "Verbose":
                 self.verbose_logging = bool(node.values[0])
             elif node.key == "MaxPacket":
                 self.max_recv_size = int(node.values[0])
+            elif node.key == "RecvBatchSize":
+                self.recv_batch_size = int(node.values[0])
+            elif node.key == "Listeners":
+                self.listeners = int(node.values[0])
+            elif node.key == "ParseWorkers":
+                self.parse_workers = int(node.values[0])
+            elif node.key == "ReceiveBuffer":
+                self.recv_buffer = int(node.values[0])
+            elif node.key == "InternalMetrics":
+                self.internal_metrics = bool(node.values[0])
+            elif node.key == "QueueSize":
+                self.queue_size = int(node.values[0])
+            elif node.key == "QueueOverflow":
+                policy = node.values[0].lower()
+                if policy in ringbuffer.OVERFLOW_POLICIES:
+                    self.queue_overflow = policy
+                else:
+                    self.log.error("unknown QueueOverflow %s, using %s" %
+                                   (policy, self.queue_overflow))
+            elif node.key == "ForwardHost":
+                self.forward_host = node.values[0]
+            elif node.key == "ForwardPort":
+                self.forward_port = int(node.values[0])
+            elif node.key == "ContextCacheSize":
+                self.context_cache_size = int(node.values[0])
+            elif node.key == "HistogramBackend":
+                backend = node.values[0].lower()
+                if backend in aggregator.HISTOGRAM_BACKENDS:
+                    self.histogram_backend = backend
+                else:
+                    self.log.error("unknown HistogramBackend %s, using %s" %
+                                   (backend, self.histogram_backend))
+            elif node.key == "HistogramRelativeError":
+                relative_error = float(node.values[0])
+                if 0 < relative_error < 1:
+                    self.histogram_relative_error = relative_error
+                else:
+                    self.log.error(
+                        "HistogramRelativeError %s not between 0 and 1, "
+                        "using %s" % (relative_error,
+                                      self.histogram_relative_error or
+                                      aggregator.DEFAULT_RELATIVE_ERROR))
+            elif node.key == "SetBackend":
+                backend = node.values[0].lower()
+                if backend in aggregator.SET_BACKENDS:
+                    self.set_backend = backend
+                else:
+                    self.log.error("unknown SetBackend %s, using %s" %
+                                   (backend, self.set_backend))
+            elif node.key == "SetPrecision":
+                precision = int(node.values[0])
+                if aggregator.MIN_PRECISION <= precision <= \
+                        aggregator.MAX_PRECISION:
+                    self.set_precision = precision
+                else:
+                    self.log.error(
+                        "SetPrecision %s not between %d and %d, using %s" %
+                        (precision, aggregator.MIN_PRECISION,
+                         aggregator.MAX_PRECISION,
+                         self.set_precision or aggregator.DEFAULT_PRECISION))
+            elif node.key == "MaxContexts":
+                self.max_contexts = int(node.values[0])
+            elif node.key == "MaxContextsPerMetric":
+                self.max_contexts_per_metric = int(node.values[0])
+            elif node.key == "Storage":
+                storage = node.values[0].lower()
+                if storage in aggregator.STORAGES:
+                    self.storage = storage
+                else:
+                    self.log.error("unknown Storage %s, using %s" %
+                                   (storage, self.storage))
             elif node.key == "Interval":
                 self.aggregator_interval = int(node.values[0])
             elif node.key == "ReadToCollectd":
@@ -126,37 +231,41 @@ class SignalfxPointSender(object):
         sfx = signalfx.SignalFx(ingest_endpoint=config.ingest_endpoint)
         self.sfx = sfx.ingest(config.api_token)
 
-    def send_points(self, metrics):
+    def send_points(self, points):
         gauges = []
         counters = []
-        for metric in metrics:
+        cumulative_counters = []
+        for point in points:
             sfx_metric = {}
-            if metric['type'] in DOG_STATSD_TYPE_TO_COLLECTD_TYPE:
-                mtype = DOG_STATSD_TYPE_TO_COLLECTD_TYPE[metric['type']]
+            if point.metric_type in DOG_STATSD_TYPE_TO_COLLECTD_TYPE:
+                mtype = DOG_STATSD_TYPE_TO_COLLECTD_TYPE[point.metric_type]
             else:
                 mtype = 'gauge'
 
             if mtype == "absolute":
                 mtype = "counter"
 
-            sfx_metric["metric"] = metric['metric']
-            sfx_metric["dimensions"] = dims_from_tags(metric['tags'])
+            sfx_metric["metric"] = point.metric
+            sfx_metric["dimensions"] = dims_from_tags(point.tags)
             if "host" not in sfx_metric["dimensions"]:
                 sfx_metric["dimensions"]["host"] = self.host
             if sfx_metric["dimensions"]["host"] == "":
                 self.log.info("waiting for host dim from metadata plugin")
                 return
-            sfx_metric["timestamp"] = int(metric['points'][0][0] * 1000)
-            sfx_metric["value"] = metric['points'][0][1]
-            if metric['type'] == "rate":
+            sfx_metric["timestamp"] = int(point.timestamp * 1000)
+            sfx_metric["value"] = point.value
+            if point.metric_type == "rate":
                 sfx_metric["value"] *= self.config.aggregator_interval
 
             if mtype == "gauge":
                 gauges.append(sfx_metric)
             elif mtype == "counter":
                 counters.append(sfx_metric)
-        self.log.verbose("Sending %d metrics" % len(metrics))
-        self.sfx.send(gauges=gauges, counters=counters)
+            elif mtype == "derive":
+                cumulative_counters.append(sfx_metric)
+        self.log.verbose("Sending %d metrics" % len(points))
+        self.sfx.send(gauges=gauges, counters=counters,
+                      cumulative_counters=cumulative_counters)
 
     def set_host(self, host):
         self.host = host
@@ -170,22 +279,22 @@ class CollectDPointSender(object):
         self.log = log
         self.plugin = plugin
 
-    def send_points(self, metrics):
-        for metric in metrics:
+    def send_points(self, points):
+        for point in points:
             val = self.Values(plugin=self.plugin, meta={'0': True})
 
-            if metric['type'] in DOG_STATSD_TYPE_TO_COLLECTD_TYPE:
-                val.type = DOG_STATSD_TYPE_TO_COLLECTD_TYPE[metric['type']]
+            if point.metric_type in DOG_STATSD_TYPE_TO_COLLECTD_TYPE:
+                val.type = DOG_STATSD_TYPE_TO_COLLECTD_TYPE[point.metric_type]
             else:
                 val.type = 'gauge'
 
-            val.type_instance = metric['metric']
-            val.plugin_instance = combine_dims(dims_from_tags(metric['tags']))
-            val.values = [metric['points'][0][1]]
-            if metric['type'] == "rate":
+            val.type_instance = point.metric
+            val.plugin_instance = combine_dims(dims_from_tags(point.tags))
+            val.values = [point.value]
+            if point.metric_type == "rate":
                 val.values[0] *= self.config.aggregator_interval
 
-            self.log.verbose("m: {} v: {}", metric, val)
+            self.log.verbose("m: {} v: {}", point, val)
             val.dispatch()
 
     def set_host(self, host):
@@ -200,6 +309,7 @@ class DogstatsDCollectD(object):
         self.log = Logger(collectd_module)
         self.plugin = plugin
         self.server = None
+        self.server_thread = None
         self.config = DogstatsDConfig(self.log)
         self.sender = CollectDPointSender(self.config, collectd_module.Values,
                                           self.plugin, self.log)
@@ -218,15 +328,41 @@ class DogstatsDCollectD(object):
     def read_callback(self):
         if self.server is None:
             return
-        metrics = self.server.metrics_aggregator.flush()
-        self.sender.send_points(metrics)
+        # Each batch is sent as soon as it is formatted, the interval's points
+        #  are never all held at once
+        batches = self.server.metrics_aggregator.flush_batches()
+        try:
+            for batch in batches:
+                self.sender.send_points(batch)
+        finally:
+            # Run the flush's bookkeeping now if a send failed, rather than
+            #  whenever the generator gets collected
+            batches.close()
+        if self.config.internal_metrics:
+            self.sender.send_points(self.internal_metrics())
+
+    def internal_metrics(self):
+        timestamp = time.time()
+        return [aggregator.Point(
+            metric=name,
+            value=value,
+            timestamp=timestamp,
+            tags=tags,
+            metric_type=metric_type,
+            interval=self.config.aggregator_interval,
+        ) for name, value, metric_type, tags in
+            self.server.internal_metrics() +
+            self.server.metrics_aggregator.internal_metrics()]
 
     def init_callback(self):
         self.log.info("plugin init %s" % self.config)
         if self.config.verbose_logging is True:
             self.log.verbose_logging = True
         assert self.server is None
-        if self.config.listen_port is None:
+        if self.config.listen_port is None and \
+                self.config.socket_path is None and \
+                self.config.tcp_port is None and \
+                self.config.stream_socket_path is None:
             self.log.info("dogstatsd port listening not enabled")
             return
         if not self.config.collectd_send:
@@ -235,17 +371,43 @@ class DogstatsDCollectD(object):
         self.server = dogstatsd.init(
             self.config.listen_ip, self.config.listen_port,
             timeout=self.config.udp_timeout,
-            aggregator_interval=self.config.aggregator_interval)
-        udp_server_thread = threading.Thread(target=self.server.start)
-        udp_server_thread.daemon = True
-        udp_server_thread.start()
+            aggregator_interval=self.config.aggregator_interval,
+            batch_size=self.config.recv_batch_size,
+            listeners=self.config.listeners,
+            workers=self.config.parse_workers,
+            socket_path=self.config.socket_path,
+            tcp_port=self.config.tcp_port,
+            stream_socket_path=self.config.stream_socket_path,
+            max_stream_connections=self.config.max_stream_connections,
+            buffer_size=self.config.max_recv_size,
+            recv_buffer=self.config.recv_buffer,
+            queue_size=self.config.queue_size,
+            queue_overflow=self.config.queue_overflow,
+            forward_to_host=self.config.forward_host,
+            forward_to_port=self.config.forward_port,
+            context_cache_size=self.config.context_cache_size,
+            storage=self.config.storage,
+            histogram_backend=self.config.histogram_backend,
+            histogram_relative_error=self.config.histogram_relative_error,
+            set_backend=self.config.set_backend,
+            set_precision=self.config.set_precision,
+            max_contexts=self.config.max_contexts,
+            max_contexts_per_name=self.config.max_contexts_per_metric)
+        self.server_thread = threading.Thread(target=self.server.start)
+        self.server_thread.daemon = True
+        self.server_thread.start()
 
     def register_shutdown(self):
         self.log.info("shutting down plugin")
         if self.server is None:
             return
+        # stop() wakes the event loop up, so this returns promptly unless the
+        #  thread is stuck elsewhere. It is a daemon thread, left behind then.
         self.server.stop()
-        while not self.server.start_has_finished.acquire(False):
-            time.sleep(.01)
-        self.server.start_has_finished.release()
+        self.server_thread.join(SHUTDOWN_TIMEOUT)
+        if self.server_thread.is_alive():
+            self.log.error("dogstatsd server thread still running after %ss, "
+                           "shutting down without it" % SHUTDOWN_TIMEOUT)
+        self.server_thread = None
+        self.server.metrics_aggregator.close()
         self.server = None
@@ -40,17 +40,24 @@ A Python Statsd implementation with some datadog special sauce.
 """
 
 # stdlib
+import errno
+import fcntl
 import logging
 import os
+import Queue
 import select
 import socket
+import stat
 import zlib
 
 import simplejson as json
 
 # project
-from aggregator import MetricsBucketAggregator, DEFAULT_HISTOGRAM_AGGREGATES, \
-    DEFAULT_HISTOGRAM_PERCENTILES
+from aggregator import MetricsBucketAggregator, ShardedMetricsAggregator, MetricTypes, \
+    DEFAULT_HISTOGRAM_AGGREGATES, DEFAULT_HISTOGRAM_PERCENTILES, STORAGE_OBJECTS, HISTOGRAM_EXACT, \
+    SET_EXACT, Point
+from aggregator_pool import ProcessPoolAggregator
+from ringbuffer import RingBuffer, DROP_NEWEST
 
 
 # urllib3 logs a bunch of stuff at the info level
@@ -67,6 +74,25 @@ DOGSTATSD_AGGREGATOR_BUCKET_SIZE = 10
 
 WATCHDOG_TIMEOUT = 120
 UDP_SOCKET_TIMEOUT = 5
+# Number of datagrams drained from the socket per wakeup. 1 keeps the
+#  historical one-recv-per-select behaviour.
+RECV_BATCH_SIZE = 1
+# Largest datagram read from a socket
+DATAGRAM_BUFFER_SIZE = 1024 * 8
+# Bytes read from a stream connection at once, and the longest partial line we
+#  keep around waiting for its newline.
+STREAM_RECV_SIZE = 256 * 1024
+STREAM_MAX_LINE = 64 * 1024
+STREAM_BACKLOG = 128
+# Open stream connections accepted at once, past that new ones are closed right away
+STREAM_MAX_CONNECTIONS = 1024
+# Forwarded lines are packed into datagrams of at most this many bytes, which fits
+#  a 1500 byte MTU once IP and UDP headers are added.
+FORWARD_PAYLOAD_SIZE = 1432
+# Received packets waiting for the forwarding thread before new ones are dropped
+FORWARD_QUEUE_SIZE = 10000
+# Kernel socket tables, used to report receive queue and drops of our udp sockets
+PROC_NET_UDP = ('/proc/net/udp', '/proc/net/udp6')
 # Since we call flush more often than the metrics aggregation interval, we should
 #  log a bunch of flushes in a row every so often.
 FLUSH_LOGGING_PERIOD = 70
@@ -91,53 +117,271 @@ def serialize_event(event):
     return json.dumps(event)
 
 
+def read_udp_socket_stats(inode, proc_files=PROC_NET_UDP):
+    """
+    Look a udp socket up by inode in the kernel socket tables. Returns the bytes waiting
+    in its receive queue and the number of datagrams the kernel dropped for it, or None.
+    """
+    inode = str(inode)
+    for proc_file in proc_files:
+        try:
+            with open(proc_file) as f:
+                f.readline()
+                for line in f:
+                    # sl local rem st tx_queue:rx_queue tr:when retrnsmt uid timeout inode ref pointer drops
+                    fields = line.split()
+                    if len(fields) >= 13 and fields[9] == inode:
+                        return int(fields[4].split(':')[1], 16), int(fields[12])
+        except (IOError, OSError, ValueError, IndexError):
+            continue
+    return None
+
+
+def unlink_socket(path):
+    """
+    Remove the unix socket at path, if there is one. Returns False, leaving it alone,
+    when something other than a socket is there.
+    """
+    try:
+        mode = os.lstat(path).st_mode
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return True
+        raise
+    if not stat.S_ISSOCK(mode):
+        return False
+    os.unlink(path)
+    return True
+
+
+class Poller(object):
+    """
+    Readiness notification for the server's sockets. Uses edge-triggered epoll where
+    available, so the callers must read each ready socket until it would block, and
+    falls back to select elsewhere.
+    """
+
+    def __init__(self):
+        self.epoll = select.epoll() if hasattr(select, 'epoll') else None
+        self.fds = set()
+
+    def register(self, fd):
+        if self.epoll is not None:
+            self.epoll.register(fd, select.EPOLLIN | select.EPOLLET)
+        self.fds.add(fd)
+
+    def unregister(self, fd):
+        if self.epoll is not None:
+            self.epoll.unregister(fd)
+        self.fds.discard(fd)
+
+    def poll(self, timeout):
+        """ File descriptors that became readable within timeout seconds """
+        if self.epoll is not None:
+            return [fd for fd, _ in self.epoll.poll(timeout)]
+        return select.select(list(self.fds), [], [], timeout)[0]
+
+    def close(self):
+        if self.epoll is not None:
+            self.epoll.close()
+        self.fds = set()
+
+
+class Forwarder(object):
+    """
+    Relays received packets to another statsd server from a background thread.
+    Lines are coalesced into datagrams of up to payload_size bytes, and forward()
+    only queues, so a slow or unreachable upstream never slows down the receive loop.
+    """
+
+    def __init__(self, host, port, payload_size=FORWARD_PAYLOAD_SIZE, queue_size=FORWARD_QUEUE_SIZE):
+        self.address = (host, int(port))
+        self.payload_size = payload_size
+        self.queue = Queue.Queue(queue_size)
+        self.sock = None
+        self.thread = None
+        self.dropped = 0
+        self.datagrams_sent = 0
+        self.send_errors = 0
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.connect(self.address)
+        self.thread = threading.Thread(target=self._run, name='dogstatsd-forward')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def forward(self, packets):
+        try:
+            self.queue.put_nowait(packets)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        queue_get = self.queue.get
+        queue_get_nowait = self.queue.get_nowait
+        while True:
+            pending = [queue_get()]
+            try:
+                while True:
+                    pending.append(queue_get_nowait())
+            except Queue.Empty:
+                pass
+            stop = pending[-1] is None
+            if stop:
+                pending.pop()
+            for datagram in self.coalesce(pending, self.payload_size):
+                try:
+                    self.sock.send(datagram)
+                    self.datagrams_sent += 1
+                except socket.error:
+                    self.send_errors += 1
+            if stop:
+                return
+
+    @staticmethod
+    def coalesce(packets, payload_size):
+        """ Pack the lines of packets into as few datagrams of at most payload_size bytes as possible """
+        datagram = []
+        size = 0
+        for packet in packets:
+            for line in packet.splitlines():
+                if not line:
+                    continue
+                line_size = len(line)
+                if datagram and size + 1 + line_size > payload_size:
+                    yield '\n'.join(datagram)
+                    datagram = []
+                    size = 0
+                size += line_size + 1 if datagram else line_size
+                datagram.append(line)
+        if datagram:
+            yield '\n'.join(datagram)
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
 class Server(object):
     """
-    A statsd udp server.
+    A statsd udp server. It can also listen on a unix datagram socket, alongside
+    or instead of the udp port, and accept newline separated metrics over tcp or
+    unix stream connections.
     """
 
-    def __init__(self, metrics_aggregator, host, port, forward_to_host=None, forward_to_port=None, timeout=UDP_SOCKET_TIMEOUT):
+    def __init__(self, metrics_aggregator, host, port, forward_to_host=None, forward_to_port=None, timeout=UDP_SOCKET_TIMEOUT,
+                 batch_size=RECV_BATCH_SIZE, reuse_port=False, socket_path=None, tcp_port=None,
+                 stream_socket_path=None, buffer_size=DATAGRAM_BUFFER_SIZE, recv_buffer=None, listener_index=0,
+                 queue_size=0, queue_overflow=DROP_NEWEST, max_stream_connections=STREAM_MAX_CONNECTIONS):
         self.host = host
-        self.port = int(port)
+        self.port = int(port) if port is not None else None
         self.address = (self.host, self.port)
+        self.socket_path = socket_path
+        self.tcp_port = int(tcp_port) if tcp_port is not None else None
+        self.stream_socket_path = stream_socket_path
         self.metrics_aggregator = metrics_aggregator
-        self.buffer_size = 1024 * 8
+        self.buffer_size = int(buffer_size)
+        self.recv_buffer = recv_buffer
+        self.listener_index = listener_index
+        self.batch_size = max(1, int(batch_size))
+        self.datagrams_received = 0
+        self.stream_connections = 0
+        self.max_stream_connections = int(max_stream_connections)
+        self.stream_connections_rejected = 0
+        self.reuse_port = reuse_port
         self.start_has_finished = threading.Semaphore()
         self.shouldStop = threading.Event()
         self.running = threading.Event()
         self.socket = None
+        self.sockets = []
+        # Paths of the unix sockets bound by this server, removed when it stops
+        self.socket_paths = []
+        # file descriptor -> (socket, callable handling it when it is readable)
+        self.readers = {}
+        self.poller = None
+        # Written to by stop() to wake the event loop up
+        self.wakeup_fds = None
+        # Held by stop() while it writes to the pipe and by start() while it closes it, so
+        #  that a closed descriptor number reused by another file is never written to
+        self.wakeup_lock = threading.Lock()
+        # stream connection -> partial line waiting for its newline, None while a line
+        #  too long is being dropped
+        self.partial_lines = {}
         self.timeout = timeout
 
+        # With a queue, a parse thread feeds the aggregator so that slow parsing or a
+        #  long flush does not stall the receive loop.
+        self.ring = None
+        self.parse_thread = None
+        self.submit_packets = metrics_aggregator.submit_packets
+        if queue_size:
+            self.ring = RingBuffer(queue_size, queue_overflow)
+            self.submit_packets = self.ring.put
+
         self.should_forward = forward_to_host is not None
 
 
-        self.forward_udp_sock = None
+        self.forwarder = None
         # In case we want to forward every packet received to another statsd server
         if self.should_forward:
             if forward_to_port is None:
                 forward_to_port = 8125
 
             log.info("External statsd forwarding enabled. All packets received will be forwarded to %s:%s" % (forward_to_host, forward_to_port))
-            try:
-                self.forward_udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                self.forward_udp_sock.connect((forward_to_host, forward_to_port))
-            except Exception:
-                log.exception("Error while setting up connection to external statsd server")
+            self.forwarder = Forwarder(forward_to_host, forward_to_port)
+            submit_packets = self.submit_packets
+            forward = self.forwarder.forward
+
+            def submit_and_forward(packets):
+                submit_packets(packets)
+                forward(packets)
+            self.submit_packets = submit_and_forward
 
     def start(self):
         try:
             self.start_has_finished.acquire()
             self._start()
         finally:
-            self.socket.close()
+            if self.parse_thread is not None:
+                self.ring.close()
+                self.parse_thread.join()
+                self.parse_thread = None
+            if self.forwarder is not None:
+                self.forwarder.close()
+            for sock in self.sockets + self.partial_lines.keys():
+                sock.close()
+            self.sockets = []
+            self.readers = {}
+            self.partial_lines = {}
+            if self.poller is not None:
+                self.poller.close()
+                self.poller = None
+            with self.wakeup_lock:
+                if self.wakeup_fds is not None:
+                    wakeup_fds, self.wakeup_fds = self.wakeup_fds, None
+                    for fd in wakeup_fds:
+                        os.close(fd)
+            for path in self.socket_paths:
+                unlink_socket(path)
+            self.socket_paths = []
             self.start_has_finished.release()
 
-    def _start(self):
-        """ Run the server. """
+    def _bind_udp(self):
         # Bind to the UDP socket.
         # IPv4 only
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.setblocking(0)
+        self.sockets.append(self.socket)
+        if self.reuse_port:
+            # Let the kernel spread datagrams over every listener bound to this port
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self._set_recv_buffer(self.socket)
         try:
             self.socket.bind(self.address)
         except socket.gaierror:
@@ -145,48 +389,366 @@ class Server(object):
                 log.warning("Warning localhost seems undefined in your host file, using 127.0.0.1 instead")
                 self.address = ('127.0.0.1', self.address[1])
                 self.socket.bind(self.address)
+        # Pick up the real port when binding to port 0
+        self.address = self.socket.getsockname()
+        self._add_reader(self.socket, self._read_datagrams)
 
         log.info('Listening on host & port: %s' % str(self.address))
 
+    def _set_recv_buffer(self, sock):
+        if not self.recv_buffer:
+            return
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(self.recv_buffer))
+        # Linux doubles the value for bookkeeping and caps it at net.core.rmem_max
+        effective = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        if effective < int(self.recv_buffer):
+            log.warning('Receive buffer capped at %d bytes instead of %d, raise net.core.rmem_max' %
+                        (effective, int(self.recv_buffer)))
+
+    def _add_reader(self, sock, handler):
+        """
+        Watch sock and call handler(sock) when it is readable. The handler returns True
+        when the socket may still have data to read, so that it is called again
+        before the loop waits.
+        """
+        fd = sock.fileno()
+        self.readers[fd] = (sock, handler)
+        self.poller.register(fd)
+
+    def _remove_reader(self, sock):
+        fd = sock.fileno()
+        self.poller.unregister(fd)
+        del self.readers[fd]
+
+    def _bind_unix(self, path, sock_type):
+        # A socket at path was left behind by a previous run, anything else is not ours
+        if not unlink_socket(path):
+            log.error('%s exists and is not a socket, not listening on it' % path)
+            return None
+        unix_socket = socket.socket(socket.AF_UNIX, sock_type)
+        unix_socket.setblocking(0)
+        self.sockets.append(unix_socket)
+        unix_socket.bind(path)
+        self.socket_paths.append(path)
+        return unix_socket
+
+    def _bind_tcp(self):
+        tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tcp_socket.setblocking(0)
+        self.sockets.append(tcp_socket)
+        tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        tcp_socket.bind((self.host, self.tcp_port))
+        tcp_socket.listen(STREAM_BACKLOG)
+        self.tcp_port = tcp_socket.getsockname()[1]
+        self._add_reader(tcp_socket, self._accept)
+
+        log.info('Listening for tcp connections on host & port: %s' % str((self.host, self.tcp_port)))
+
+    def _start(self):
+        """ Run the server. """
+        self.poller = Poller()
+        self.wakeup_fds = os.pipe()
+        for fd in self.wakeup_fds:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.readers[self.wakeup_fds[0]] = (self.wakeup_fds[0], self._read_wakeup)
+        self.poller.register(self.wakeup_fds[0])
+
+        if self.port is not None:
+            self._bind_udp()
+        if self.socket_path is not None:
+            # A full unix datagram socket blocks the sender instead of dropping
+            unix_socket = self._bind_unix(self.socket_path, socket.SOCK_DGRAM)
+            if unix_socket is not None:
+                self._set_recv_buffer(unix_socket)
+                self._add_reader(unix_socket, self._read_datagrams)
+                log.info('Listening on unix socket: %s' % self.socket_path)
+        if self.tcp_port is not None:
+            self._bind_tcp()
+        if self.stream_socket_path is not None:
+            stream_socket = self._bind_unix(self.stream_socket_path, socket.SOCK_STREAM)
+            if stream_socket is not None:
+                stream_socket.listen(STREAM_BACKLOG)
+                self._add_reader(stream_socket, self._accept)
+                log.info('Listening for stream connections on unix socket: %s' % self.stream_socket_path)
+        if self.forwarder is not None:
+            try:
+                self.forwarder.start()
+            except Exception:
+                log.exception("Error while setting up connection to external statsd server")
+        if self.ring is not None:
+            self.parse_thread = threading.Thread(target=self._parse_loop, name='dogstatsd-parse')
+            self.parse_thread.daemon = True
+            self.parse_thread.start()
+        self.running.set()
+
         # Inline variables for quick look-up.
-        buffer_size = self.buffer_size
-        aggregator_submit = self.metrics_aggregator.submit_packets
-        sock = [self.socket]
-        socket_recv = self.socket.recv
-        select_select = select.select
-        select_error = select.error
+        readers = self.readers
+        poll = self.poller.poll
+        should_stop = self.shouldStop.is_set
         timeout = self.timeout
-        should_forward = self.should_forward
-        forward_udp_sock = self.forward_udp_sock
+        # Sockets that may still hold data after their handler ran
+        pending = set()
 
-        # Run our select loop.
-        while not self.shouldStop.is_set():
-            # print "Running is NOT clear ---- %s %s" % (self.running, self.running.isSet())
+        # Run our event loop.
+        while not should_stop():
             try:
-                ready = select_select(sock, [], [], timeout)
-                if ready[0]:
-                    message = socket_recv(buffer_size)
-                    aggregator_submit(message)
-
-                    if should_forward:
-                        forward_udp_sock.send(message)
-            except select_error, se:
+                ready = poll(0 if pending else timeout)
+                if pending:
+                    ready = pending.union(ready)
+                    pending = set()
+            except (select.error, IOError, OSError), se:
                 # Ignore interrupted system calls from sigterm.
-                errno = se[0]
-                if errno != 4:
+                if se.args[0] != errno.EINTR:
                     raise
+                continue
             except (KeyboardInterrupt, SystemExit):
                 break
+            for fd in ready:
+                reader = readers.get(fd)
+                if reader is None:
+                    continue
+                try:
+                    if reader[1](reader[0]):
+                        pending.add(fd)
+                except (KeyboardInterrupt, SystemExit):
+                    return
+                except Exception:
+                    log.exception('Error receiving datagram')
+                    # Edge-triggered: there is no new event for what is left unread
+                    pending.add(fd)
+
+    def _read_wakeup(self, fd):
+        try:
+            while os.read(fd, 4096):
+                pass
+        except OSError:
+            pass
+        return False
+
+    def _parse_loop(self):
+        """ Feed the aggregator from the queue until the server stops and the queue is empty """
+        get_all = self.ring.get_all
+        aggregator_submit = self.metrics_aggregator.submit_packets
+        while True:
+            packets = get_all()
+            if not packets:
+                return
+            try:
+                aggregator_submit('\n'.join(packets))
             except Exception:
-                log.exception('Error receiving datagram')
+                log.exception('Error parsing packets')
+
+    def _read_datagrams(self, sock):
+        if self.batch_size > 1:
+            messages = self._receive_batch(sock.recv, self.buffer_size, self.batch_size)
+            if messages:
+                self.datagrams_received += len(messages)
+                # One aggregator call per batch. Datagrams are joined on
+                #  newlines, which submit_packets already splits on.
+                self.submit_packets('\n'.join(messages))
+            # A full batch may have left datagrams behind
+            return len(messages) == self.batch_size
+
+        try:
+            message = sock.recv(self.buffer_size)
+        except socket.error, se:
+            if se.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            if se.errno == errno.EINTR:
+                return True
+            raise
+        self.datagrams_received += 1
+        self.submit_packets(message)
+        return True
+
+    def _accept(self, listening_socket):
+        while True:
+            try:
+                conn, _ = listening_socket.accept()
+            except socket.error, se:
+                if se.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+                if se.errno in (errno.EINTR, errno.ECONNABORTED):
+                    continue
+                raise
+            if self.stream_connections >= self.max_stream_connections:
+                if not self.stream_connections_rejected:
+                    log.warning('%d stream connections are open, closing new ones' % self.stream_connections)
+                self.stream_connections_rejected += 1
+                conn.close()
+                continue
+            conn.setblocking(0)
+            self.stream_connections += 1
+            self.partial_lines[conn] = ''
+            self._add_reader(conn, self._read_stream)
+            # Data may have arrived before the connection was watched
+            self._read_stream(conn)
+
+    def _read_stream(self, conn):
+        """
+        Hand every complete line received on a stream connection to the aggregator in
+        one call. The trailing partial line is kept until its newline arrives, unless it
+        grows past STREAM_MAX_LINE: it is then dropped up to its newline.
+        """
+        if conn not in self.partial_lines:
+            # Closed earlier in this loop iteration
+            return False
+        try:
+            data = conn.recv(STREAM_RECV_SIZE)
+        except socket.error, se:
+            if se.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            if se.errno == errno.EINTR:
+                return True
+            data = ''
+        partial = self.partial_lines[conn]
+
+        if not data:
+            # Connection closed, whatever is left is a last unterminated line
+            self._remove_reader(conn)
+            del self.partial_lines[conn]
+            conn.close()
+            if partial:
+                self.submit_packets(partial)
+            self.stream_connections -= 1
+            return False
+
+        last_newline = data.rfind('\n')
+        if last_newline < 0:
+            # None: inside a line that is being dropped
+            if partial is not None:
+                partial += data
+        else:
+            if partial is None:
+                self.submit_packets(data[data.find('\n') + 1:last_newline])
+            else:
+                self.submit_packets(partial + data[:last_newline])
+            partial = data[last_newline + 1:]
+        if partial is not None and len(partial) > STREAM_MAX_LINE:
+            log.warning('Discarding a line longer than %d bytes' % STREAM_MAX_LINE)
+            partial = None
+        self.partial_lines[conn] = partial
+        # A full read may have left more behind
+        return len(data) == STREAM_RECV_SIZE
+
+    def internal_metrics(self):
+        """ (name, value, metric_type, tags) tuples describing the listener itself """
+        tags = ('listener:%d' % self.listener_index,)
+        metrics = [
+            ('dogstatsd.datagrams', self.datagrams_received, MetricTypes.COUNTER, tags),
+            ('dogstatsd.stream.connections', self.stream_connections, MetricTypes.GAUGE, tags),
+            ('dogstatsd.stream.rejected', self.stream_connections_rejected, MetricTypes.COUNTER, tags),
+        ]
+        udp_socket = self.socket
+        if udp_socket is not None and udp_socket in self.sockets:
+            try:
+                stats = read_udp_socket_stats(os.fstat(udp_socket.fileno()).st_ino)
+            except (socket.error, OSError):
+                stats = None
+            if stats is not None:
+                rx_queue, drops = stats
+                udp_tags = tags + ('port:%d' % self.address[1],)
+                metrics.append(('dogstatsd.socket.queued_bytes', rx_queue, MetricTypes.GAUGE, udp_tags))
+                metrics.append(('dogstatsd.socket.drops', drops, MetricTypes.COUNTER, udp_tags))
+        if self.ring is not None:
+            metrics.append(('dogstatsd.queue.depth', self.ring.depth, MetricTypes.GAUGE, tags))
+            metrics.append(('dogstatsd.queue.high_water', self.ring.reset_high_water(), MetricTypes.GAUGE, tags))
+            metrics.append(('dogstatsd.queue.drops', self.ring.dropped, MetricTypes.COUNTER, tags))
+        if self.forwarder is not None:
+            metrics.append(('dogstatsd.forward.datagrams', self.forwarder.datagrams_sent, MetricTypes.COUNTER, tags))
+            metrics.append(('dogstatsd.forward.drops', self.forwarder.dropped, MetricTypes.COUNTER, tags))
+            metrics.append(('dogstatsd.forward.errors', self.forwarder.send_errors, MetricTypes.COUNTER, tags))
+        return metrics
+
+    @staticmethod
+    def _receive_batch(socket_recv, buffer_size, batch_size):
+        """ Drain up to batch_size pending datagrams without blocking. """
+        messages = []
+        while len(messages) < batch_size:
+            try:
+                messages.append(socket_recv(buffer_size))
+            except socket.error, se:
+                if se.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                if se.errno == errno.EINTR:
+                    continue
+                raise
+        return messages
 
     def stop(self):
         self.shouldStop.set()
-        # print "STOP().  Will clear running %s %s" % (self.running, self.running.isSet())
+        with self.wakeup_lock:
+            if self.wakeup_fds is not None:
+                try:
+                    os.write(self.wakeup_fds[1], 'x')
+                except OSError:
+                    # The pipe is full, the loop wakes up anyway
+                    pass
+
+
+class ServerGroup(object):
+    """
+    Several Servers sharing one port through SO_REUSEPORT, each running in its own
+    thread and feeding its own aggregator shard. metrics_aggregator merges the shards
+    when it is flushed.
+    """
+
+    def __init__(self, metrics_aggregator, servers):
+        self.metrics_aggregator = metrics_aggregator
+        self.servers = servers
+        self.start_has_finished = threading.Semaphore()
+        self.running = threading.Event()
 
+    @property
+    def address(self):
+        return self.servers[0].address
 
+    @property
+    def datagrams_received(self):
+        return sum(server.datagrams_received for server in self.servers)
 
-def init(server_host, port, timeout=UDP_SOCKET_TIMEOUT, aggregator_interval=DOGSTATSD_AGGREGATOR_BUCKET_SIZE):
+    def start(self):
+        try:
+            self.start_has_finished.acquire()
+            threads = []
+            for server in self.servers:
+                if threads:
+                    # Follow the first listener when it was bound to an ephemeral port
+                    server.address = (server.address[0], self.address[1])
+                thread = threading.Thread(target=server.start)
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+                while not server.running.wait(.1) and thread.is_alive():
+                    pass
+                if not server.running.is_set():
+                    log.error("Listener %d of %d failed to start" % (len(threads), len(self.servers)))
+                    break
+            else:
+                self.running.set()
+            for thread in threads:
+                thread.join()
+        finally:
+            self.start_has_finished.release()
+
+    def internal_metrics(self):
+        metrics = []
+        for server in self.servers:
+            metrics += server.internal_metrics()
+        return metrics
+
+    def stop(self):
+        for server in self.servers:
+            server.stop()
+
+
+def init(server_host, port, timeout=UDP_SOCKET_TIMEOUT, aggregator_interval=DOGSTATSD_AGGREGATOR_BUCKET_SIZE,
+         batch_size=RECV_BATCH_SIZE, listeners=1, workers=0, socket_path=None, tcp_port=None,
+         stream_socket_path=None, buffer_size=DATAGRAM_BUFFER_SIZE, recv_buffer=None, queue_size=0,
+         queue_overflow=DROP_NEWEST, forward_to_host=None, forward_to_port=None,
+         context_cache_size=None, storage=STORAGE_OBJECTS, histogram_backend=HISTOGRAM_EXACT,
+         histogram_relative_error=None, set_backend=SET_EXACT, set_precision=None,
+         max_contexts=0, max_contexts_per_name=0, max_stream_connections=STREAM_MAX_CONNECTIONS):
     """Configure the server and the reporting thread.
     """
 
@@ -194,16 +756,59 @@ def init(server_host, port, timeout=UDP_SOCKET_TIMEOUT, aggregator_interval=DOGS
 
     hostname = None
 
-    aggregator = MetricsBucketAggregator(
-        hostname,
-        aggregator_interval,
+    aggregator_kwargs = dict(
         recent_point_threshold=None,
-        formatter=None,
+        formatter=Point,
         histogram_aggregates=DEFAULT_HISTOGRAM_AGGREGATES,
         histogram_percentiles=DEFAULT_HISTOGRAM_PERCENTILES,
         utf8_decoding=True,
+        context_cache_size=context_cache_size,
+        storage=storage,
+        histogram_backend=histogram_backend,
+        histogram_relative_error=histogram_relative_error,
+        set_backend=set_backend,
+        set_precision=set_precision,
+        max_contexts=max_contexts,
+        max_contexts_per_name=max_contexts_per_name,
     )
 
-    server = Server(aggregator, server_host, port, timeout=timeout)
-
-    return server
+    if listeners > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        log.warning("SO_REUSEPORT is not supported on this platform, using a single listener")
+        listeners = 1
+    if listeners > 1 and port is None:
+        log.warning("Multiple listeners need a udp port, using a single listener")
+        listeners = 1
+
+    if workers > 0:
+        # Every listener ships raw packets to the same pool of parsing processes.
+        #  The workers are forked before any socket is opened.
+        aggregator = ProcessPoolAggregator(workers, hostname, aggregator_interval, **aggregator_kwargs)
+        aggregator.start()
+        shards = [aggregator] * listeners
+    elif listeners > 1:
+        shards = [MetricsBucketAggregator(hostname, aggregator_interval, **aggregator_kwargs)
+                  for _ in range(listeners)]
+        aggregator = ShardedMetricsAggregator(shards, hostname, aggregator_interval, **aggregator_kwargs)
+    else:
+        aggregator = MetricsBucketAggregator(hostname, aggregator_interval, **aggregator_kwargs)
+        shards = [aggregator]
+
+    if listeners <= 1:
+        return Server(aggregator, server_host, port, forward_to_host=forward_to_host,
+                      forward_to_port=forward_to_port, timeout=timeout, batch_size=batch_size,
+                      socket_path=socket_path, tcp_port=tcp_port, stream_socket_path=stream_socket_path,
+                      buffer_size=buffer_size, recv_buffer=recv_buffer, queue_size=queue_size,
+                      queue_overflow=queue_overflow, max_stream_connections=max_stream_connections)
+
+    servers = [Server(shard, server_host, port, forward_to_host=forward_to_host,
+                      forward_to_port=forward_to_port, timeout=timeout, batch_size=batch_size, reuse_port=True,
+                      buffer_size=buffer_size, recv_buffer=recv_buffer, listener_index=index,
+                      queue_size=queue_size, queue_overflow=queue_overflow,
+                      max_stream_connections=max_stream_connections)
+               for index, shard in enumerate(shards)]
+    # The other sockets are not sharded, the first listener serves them
+    servers[0].socket_path = socket_path
+    servers[0].tcp_port = tcp_port
+    servers[0].stream_socket_path = stream_socket_path
+
+    return ServerGroup(aggregator, servers)
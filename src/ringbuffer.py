@@ -0,0 +1,86 @@
+"""
+A bounded, preallocated ring buffer handing packets from the receive thread to the
+parse thread.
+"""
+# stdlib
+import threading
+
+# What to do with a packet that arrives while the ring is full
+DROP_NEWEST = 'drop_newest'
+DROP_OLDEST = 'drop_oldest'
+OVERFLOW_POLICIES = (DROP_NEWEST, DROP_OLDEST)
+
+
+class RingBuffer(object):
+    """
+    A fixed size FIFO of packets. put() never blocks: once the ring is full it drops
+    either the incoming packet or the oldest queued one, and counts it.
+    """
+
+    def __init__(self, capacity, overflow=DROP_NEWEST):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy %s, expected one of %s' %
+                             (overflow, ', '.join(OVERFLOW_POLICIES)))
+        self.capacity = int(capacity)
+        if self.capacity < 1:
+            raise ValueError('Ring buffer capacity must be positive')
+        self.overflow = overflow
+        self.slots = [None] * self.capacity
+        self.head = 0
+        self.depth = 0
+        self.high_water = 0
+        self.dropped = 0
+        self.closed = False
+        self.not_empty = threading.Condition(threading.Lock())
+
+    def put(self, packet):
+        """ Queue a packet. Returns False when a packet had to be dropped. """
+        with self.not_empty:
+            capacity = self.capacity
+            accepted = True
+            if self.depth == capacity:
+                self.dropped += 1
+                if self.overflow == DROP_NEWEST:
+                    return False
+                self.slots[self.head] = None
+                self.head = (self.head + 1) % capacity
+                self.depth -= 1
+                accepted = False
+            self.slots[(self.head + self.depth) % capacity] = packet
+            self.depth += 1
+            if self.depth > self.high_water:
+                self.high_water = self.depth
+            self.not_empty.notify()
+            return accepted
+
+    def get_all(self):
+        """
+        Wait for packets and return all of those queued, oldest first. Returns an empty
+        list once the ring is closed and drained.
+        """
+        with self.not_empty:
+            while not self.depth and not self.closed:
+                self.not_empty.wait()
+            packets = []
+            slots = self.slots
+            capacity = self.capacity
+            head = self.head
+            for _ in xrange(self.depth):
+                packets.append(slots[head])
+                slots[head] = None
+                head = (head + 1) % capacity
+            self.head = head
+            self.depth = 0
+            return packets
+
+    def reset_high_water(self):
+        """ Return the high-water mark and start a new measurement from the current depth """
+        with self.not_empty:
+            high_water = self.high_water
+            self.high_water = self.depth
+            return high_water
+
+    def close(self):
+        with self.not_empty:
+            self.closed = True
+            self.not_empty.notify_all()
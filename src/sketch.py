@@ -0,0 +1,233 @@
+"""
+Bounded-memory sketches: quantiles for histograms and timers, distinct counts for sets.
+
+DDSketch (Masson, Rim and Lee, VLDB 2019) maps every positive value x to the bin
+ceil(log(x) / log(gamma)), with gamma = (1 + a) / (1 - a), and only counts the values
+in each bin. Any quantile read back is within a relative error a of the exact one,
+whatever the number of samples. Negative values go to a mirrored set of bins and zeros
+are counted apart.
+
+HyperLogLog (Flajolet et al., 2007) splits a 64 bit hash of each member into a
+register index and the position of its first set bit, and keeps the highest position
+seen by each of its 2 ** precision registers. The standard error of the distinct
+count is about 1.04 / sqrt(2 ** precision).
+"""
+# stdlib
+import hashlib
+import heapq
+import math
+import struct
+
+# Relative accuracy of the quantiles, 1%
+DEFAULT_RELATIVE_ERROR = 0.01
+# Bins kept for each sign. With a 1% error, 2048 bins span values over 17 orders of
+#  magnitude before the bins closest to zero are collapsed together.
+DEFAULT_MAX_BINS = 2048
+
+# 2 ** 14 registers, a 0.8% standard error in 16KB
+DEFAULT_PRECISION = 14
+MIN_PRECISION = 4
+MAX_PRECISION = 18
+
+
+class DDSketch(object):
+    """
+    Counts of values by logarithmic bin. Memory is bounded by max_bins and reading
+    a quantile only walks the bins, so neither grows with the number of samples.
+    """
+    __slots__ = ('relative_error', 'gamma', 'log_gamma', 'max_bins', 'bins',
+                 'negative_bins', 'zero_count', 'count', 'min', 'max', 'sum')
+
+    def __init__(self, relative_error=DEFAULT_RELATIVE_ERROR, max_bins=DEFAULT_MAX_BINS):
+        if not 0 < relative_error < 1:
+            raise ValueError('Sketch relative error must be between 0 and 1, got %s' % relative_error)
+        self.relative_error = relative_error
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.clear()
+
+    def clear(self):
+        """ Forget every value """
+        # bin -> number of values, for positive values and the absolute value of negative ones
+        self.bins = {}
+        self.negative_bins = {}
+        self.zero_count = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.sum = 0
+
+    def add(self, value):
+        """ Add a value. NaN and infinite values are ignored. """
+        if value != value or value in (float('inf'), float('-inf')):
+            return
+        if value > 0:
+            self._increment(self.bins, int(math.ceil(math.log(value) / self.log_gamma)), 1)
+        elif value < 0:
+            self._increment(self.negative_bins, int(math.ceil(math.log(-value) / self.log_gamma)), 1)
+        else:
+            self.zero_count += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """ Add the values of a sketch with the same relative error """
+        for bins, other_bins in [(self.bins, other.bins), (self.negative_bins, other.negative_bins)]:
+            for key, count in other_bins.iteritems():
+                self._increment(bins, key, count)
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def _increment(self, bins, key, count):
+        if key in bins:
+            bins[key] += count
+            return
+        bins[key] = count
+        if len(bins) > self.max_bins:
+            # Fold the bins closest to zero into one, they lose their accuracy first.
+            #  A sixteenth of the bins is freed at once, so that the lowest are looked
+            #  for once every max_bins / 16 new bins rather than on each.
+            lowest = heapq.nsmallest(len(bins) - self.max_bins + self.max_bins // 16 + 1, bins)
+            collapsed = lowest.pop()
+            for low in lowest:
+                bins[collapsed] += bins.pop(low)
+
+    def _value(self, key):
+        # The bin's values are in (gamma ** (key - 1), gamma ** key], this is within
+        #  relative_error of all of them
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def value_at_rank(self, rank):
+        """
+        The value that would be at index rank of the sorted samples, within the
+        relative error. Negative ranks count from the end, as list indices do.
+        """
+        if not self.count:
+            raise IndexError('Empty sketch')
+        if rank < 0:
+            rank += self.count
+        rank = min(max(rank, 0), self.count - 1)
+        if rank == 0:
+            return self.min
+        if rank == self.count - 1:
+            return self.max
+
+        seen = 0
+        value = None
+        for key in sorted(self.negative_bins, reverse=True):
+            seen += self.negative_bins[key]
+            if seen > rank:
+                value = -self._value(key)
+                break
+        else:
+            seen += self.zero_count
+            if seen > rank:
+                value = 0
+            else:
+                for key in sorted(self.bins):
+                    seen += self.bins[key]
+                    if seen > rank:
+                        value = self._value(key)
+                        break
+        return min(max(value, self.min), self.max)
+
+    def __len__(self):
+        return self.count
+
+
+class HyperLogLog(object):
+    """
+    Estimates the number of distinct members added. Until a few registers are set they
+    are kept in a dict; past that in a bytearray of 2 ** precision registers, which
+    bounds memory whatever the number of members.
+    """
+    __slots__ = ('precision', 'sparse', 'registers', 'scaled_sum', 'zeros')
+
+    def __init__(self, precision=DEFAULT_PRECISION):
+        if not MIN_PRECISION <= precision <= MAX_PRECISION:
+            raise ValueError('HyperLogLog precision must be between %d and %d, got %s' %
+                             (MIN_PRECISION, MAX_PRECISION, precision))
+        self.precision = precision
+        self.clear()
+
+    def clear(self):
+        """ Forget every member """
+        # register -> rank, while few registers are set
+        self.sparse = {}
+        self.registers = None
+        # Once dense: sum of 2 ** (64 - rank) over the registers, and registers still 0
+        self.scaled_sum = 0
+        self.zeros = 0
+
+    def add(self, member):
+        """ Add a member, a byte string """
+        hashed = struct.unpack('<Q', hashlib.md5(member).digest()[:8])[0]
+        index = hashed >> (64 - self.precision)
+        rest = (hashed << self.precision) & 0xffffffffffffffff
+        # Position of the first set bit after the index bits
+        rank = 65 - rest.bit_length() if rest else 65 - self.precision
+        self._update(index, rank)
+
+    def _update(self, index, rank):
+        registers = self.registers
+        if registers is None:
+            if rank > self.sparse.get(index, 0):
+                self.sparse[index] = rank
+                if len(self.sparse) > (1 << self.precision) // 64:
+                    self._densify()
+            return
+        current = registers[index]
+        if rank > current:
+            registers[index] = rank
+            if current:
+                self.scaled_sum -= 1 << (64 - current)
+            else:
+                self.zeros -= 1
+                self.scaled_sum -= 1 << 64
+            self.scaled_sum += 1 << (64 - rank)
+
+    def _densify(self):
+        size = 1 << self.precision
+        self.registers = bytearray(size)
+        self.scaled_sum = size << 64
+        self.zeros = size
+        sparse, self.sparse = self.sparse, {}
+        for index, rank in sparse.iteritems():
+            self._update(index, rank)
+
+    def merge(self, other):
+        """ Add the members of a HyperLogLog with the same precision """
+        if other.registers is None:
+            for index, rank in other.sparse.iteritems():
+                self._update(index, rank)
+            return
+        if self.registers is None:
+            self._densify()
+        registers = bytearray(map(max, self.registers, other.registers))
+        self.registers = registers
+        self.zeros = registers.count('\0')
+        self.scaled_sum = sum(1 << (64 - rank) for rank in registers)
+
+    def __len__(self):
+        """ The estimated number of distinct members """
+        size = 1 << self.precision
+        if self.registers is None:
+            if not self.sparse:
+                return 0
+            # Linear counting, exact enough while most registers are empty
+            return int(round(size * math.log(float(size) / (size - len(self.sparse)))))
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size * (1 << 64) / float(self.scaled_sum)
+        if estimate <= 2.5 * size and self.zeros:
+            estimate = size * math.log(float(size) / self.zeros)
+        return int(round(estimate))